@@ -0,0 +1,332 @@
+"""Offline load generator for the leveling cog.
+
+Drives LevelingSystem with stub Discord objects against a throwaway SQLite
+database and prints a JSON report:
+
+    python -m benchmarks.leveling_bench --scenario all --output before.json
+    python -m benchmarks.leveling_bench --scenario all --compare before.json
+
+Time inside the cog is simulated, so message rates and cooldowns behave as they
+would live while the benchmark itself runs as fast as the event loop allows.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import discord
+
+SCENARIOS = ('cold_start', 'steady', 'raid', 'leaderboard_storm', 'voice')
+
+
+class SimulatedClock:
+    def __init__(self, start=1_700_000_000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class StubChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return SimpleNamespace(edit=self._edit)
+
+    async def _edit(self, **kwargs):
+        pass
+
+
+class StubRole:
+    def __init__(self, role_id, position):
+        self.id = role_id
+        self.name = f"role-{role_id}"
+        self.position = position
+
+    def __le__(self, other):
+        return self.position <= other.position
+
+    def __ge__(self, other):
+        return self.position >= other.position
+
+
+class StubGuild:
+    def __init__(self, guild_id, channels):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.channels = [StubChannel(guild_id * 1000 + i) for i in range(channels)]
+        self.roles = {}
+        self.me = SimpleNamespace(top_role=StubRole(0, 1_000_000))
+        self.members = {}
+        self.voice_channels = []
+        self.afk_channel = None
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+
+class StubMember:
+    def __init__(self, user_id, guild):
+        self.id = user_id
+        self.guild = guild
+        self.bot = False
+        self.name = self.display_name = f"user-{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.color = discord.Color.default()
+        self.avatar = None
+        self.default_avatar = SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png")
+        self._roles = set()
+        self.voice = None
+
+    def get_role(self, role_id):
+        return self.guild.roles.get(role_id) if role_id in self._roles else None
+
+    async def add_roles(self, *roles, reason=None):
+        self._roles.update(role.id for role in roles)
+
+
+class StubContext:
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.prefix = '/'
+
+    async def send(self, content=None, **kwargs):
+        return SimpleNamespace(edit=self._edit)
+
+    async def _edit(self, **kwargs):
+        pass
+
+
+class Workload:
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.guilds = [StubGuild(g + 1, args.channels) for g in range(args.guilds)]
+        for guild in self.guilds:
+            for level in (5, 10, 20):
+                guild.roles[guild.id * 100 + level] = StubRole(guild.id * 100 + level, level)
+            for u in range(args.users):
+                member = StubMember(guild.id * 1_000_000 + u, guild)
+                guild.members[member.id] = member
+        # Zipf-like weights: a few hot users send most of the messages.
+        weights = [1 / (rank + 1) ** args.skew for rank in range(args.users)]
+        self.user_cum_weights = list(itertools.accumulate(weights))
+
+    def message(self, guild=None, user_index=None):
+        guild = guild or self.rng.choice(self.guilds)
+        if user_index is None:
+            user_index = self.rng.choices(range(self.args.users), cum_weights=self.user_cum_weights)[0]
+        author = guild.members[guild.id * 1_000_000 + user_index]
+        channel = self.rng.choice(guild.channels)
+        return SimpleNamespace(author=author, guild=guild, channel=channel, content="hello")
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Bench:
+    def __init__(self, args, scenario):
+        self.args = args
+        self.scenario = scenario
+        self.rng = random.Random(args.seed)
+        self.clock = SimulatedClock()
+        self.latencies = {}
+
+    async def setup(self):
+        from cogs import leveling
+
+        os.environ['LEVELING_FLUSH_INTERVAL'] = str(self.args.flush_interval)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(self.tmpdir.name, 'bench.db')}"
+        self.bot = SimpleNamespace(database_url=url, get_channel=lambda channel_id: None,
+                                   guilds=[], wait_until_ready=self._no_wait)
+        self.cog = leveling.LevelingSystem(self.bot)
+        leveling.time = self.clock
+        await self.cog.cog_load()
+        self.workload = Workload(self.args, self.rng)
+        for guild in self.workload.guilds:
+            await self.cog.storage.update_guild_settings(guild.id, cooldown_seconds=self.args.cooldown, voice_xp_per_minute=10)
+            for role_id, role in guild.roles.items():
+                await self.cog.storage.set_level_role(guild.id, role.position, role_id)
+
+    async def _no_wait(self):
+        pass
+
+    async def teardown(self):
+        from cogs import leveling
+
+        await self.cog.cog_unload()
+        leveling.time = time
+        self.tmpdir.cleanup()
+
+    async def timed(self, kind, coro):
+        start = time.perf_counter()
+        await coro
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def deliver(self, message):
+        # Time the message until its XP is applied, not just until it is queued.
+        await self.cog.on_message(message)
+        await self.cog.xp_events.join()
+
+    async def send_messages(self, count, rate, **pick):
+        for _ in range(count):
+            self.clock.advance(1 / rate)
+            await self.timed('on_message', self.deliver(self.workload.message(**pick)))
+
+    async def run(self):
+        await self.setup()
+        try:
+            db_ops_before = self.cog.metrics.counters.get('db_ops', 0)
+            start = time.perf_counter()
+            await getattr(self, f"scenario_{self.scenario}")()
+            elapsed = time.perf_counter() - start
+            db_ops = self.cog.metrics.counters.get('db_ops', 0) - db_ops_before
+            counters = dict(self.cog.metrics.counters)
+        finally:
+            await self.teardown()
+        return self.report(elapsed, db_ops, counters)
+
+    async def scenario_cold_start(self):
+        # Every user's first message, so every settings, user and rank lookup misses.
+        for guild in self.workload.guilds:
+            for u in range(self.args.users):
+                self.clock.advance(1 / self.args.rate)
+                await self.timed('on_message', self.deliver(self.workload.message(guild, u)))
+
+    async def scenario_steady(self):
+        await self.send_messages(self.args.messages, self.args.rate)
+
+    async def scenario_raid(self):
+        # One guild gets the whole burst at 50x the normal rate.
+        await self.send_messages(self.args.messages // 4, self.args.rate)
+        await self.send_messages(self.args.messages, self.args.rate * 50, guild=self.workload.guilds[0])
+
+    async def scenario_leaderboard_storm(self):
+        await self.send_messages(self.args.messages // 2, self.args.rate)
+        guilds = self.workload.guilds
+        for i in range(self.args.messages):
+            guild = guilds[i % len(guilds)]
+            if i % 3 == 0:
+                await self.send_messages(1, self.args.rate, guild=guild)
+            author = self.workload.message(guild).author
+            ctx = StubContext(guild, author)
+            await self.timed('leaderboard', type(self.cog).leaderboard.callback(self.cog, ctx, self.rng.randint(1, 5)))
+            await self.timed('rank', type(self.cog).rank.callback(self.cog, ctx, None))
+
+    async def scenario_voice(self):
+        # A quarter of every guild's users sit in voice; each sweep is one simulated minute.
+        for guild in self.workload.guilds:
+            channel = SimpleNamespace(id=guild.id * 1000 + 999, members=[], mention=f"<#{guild.id * 1000 + 999}>", send=guild.channels[0].send)
+            guild.voice_channels.append(channel)
+            for member in list(guild.members.values())[:max(2, self.args.users // 4)]:
+                member.voice = SimpleNamespace(deaf=False, self_deaf=False, channel=channel)
+                channel.members.append(member)
+        self.bot.guilds = self.workload.guilds
+        for _ in range(max(1, self.args.messages // 100)):
+            self.clock.advance(60)
+            await self.timed('voice_sweep', self.sweep())
+        await self.send_messages(self.args.messages // 4, self.args.rate)
+
+    async def sweep(self):
+        await self.cog.sweep_voice(1)
+        await self.cog.xp_events.join()
+
+    def report(self, elapsed, db_ops, counters):
+        messages = len(self.latencies.get('on_message', ()))
+        result = {
+            'scenario': self.scenario,
+            'elapsed_seconds': round(elapsed, 4),
+            'messages': messages,
+            'messages_per_second': round(messages / elapsed, 1) if elapsed else 0.0,
+            'db_ops_per_message': round(db_ops / messages, 3) if messages else 0.0,
+            'counters': counters,
+            'latency_ms': {},
+        }
+        for kind, values in sorted(self.latencies.items()):
+            values.sort()
+            result['latency_ms'][kind] = {
+                'count': len(values),
+                'p50': round(percentile(values, 0.50) * 1000, 4),
+                'p95': round(percentile(values, 0.95) * 1000, 4),
+                'p99': round(percentile(values, 0.99) * 1000, 4),
+            }
+        return result
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {entry['scenario']: entry for entry in json.load(f)['results']}
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            continue
+        rows = [('messages_per_second', before['messages_per_second'], result['messages_per_second']),
+                ('db_ops_per_message', before['db_ops_per_message'], result['db_ops_per_message'])]
+        for kind, stats in result['latency_ms'].items():
+            if kind in before['latency_ms']:
+                rows.append((f"{kind} p99 ms", before['latency_ms'][kind]['p99'], stats['p99']))
+        print(f"[{result['scenario']}]", file=sys.stderr)
+        for name, old, new in rows:
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"  {name:<24} {old:>12} -> {new:<12} {change}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--users', type=int, default=200, help="users per guild")
+    parser.add_argument('--channels', type=int, default=3, help="channels per guild")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=50.0, help="simulated messages per second")
+    parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent for hot users; 0 is uniform")
+    parser.add_argument('--cooldown', type=int, default=60, help="guild XP cooldown in seconds")
+    parser.add_argument('--flush-interval', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="baseline JSON report to diff against")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    results = []
+    for scenario in scenarios:
+        result = await Bench(args, scenario).run()
+        results.append(result)
+        print(f"{scenario}: {result['messages_per_second']} msg/s, "
+              f"{result['db_ops_per_message']} db ops/msg", file=sys.stderr)
+    report = {'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}, 'results': results}
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
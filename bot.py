@@ -1,23 +1,57 @@
 import discord
 import os
 import asyncio
+import multiprocessing
+import multiprocessing.connection
+import signal
+import tempfile
 from discord.ext import commands
 from dotenv import load_dotenv
 import logging
 
+from utils.state_service import run_state_service
+
 load_dotenv()
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+DATABASE_URL = os.getenv('LEVELING_DATABASE_URL', 'sqlite:///leveling.db')
+WORKERS = int(os.getenv('LEVELING_WORKERS', '1'))
+SHARD_COUNT = int(os.getenv('LEVELING_SHARD_COUNT', '0')) or WORKERS
+STATE_SOCKET = os.getenv('LEVELING_STATE_SOCKET')
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('discord')
 
-async def load_cogs():
+def create_bot(database_url=DATABASE_URL, shard_ids=None, shard_count=None):
+    if shard_ids is None:
+        bot = commands.Bot(command_prefix='!', intents=intents)
+    else:
+        bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_ids=shard_ids, shard_count=shard_count)
+    bot.database_url = database_url
+
+    # setup_hook runs once, after login and before the gateway connects, so cogs
+    # (and their schema setup) are in place before the first event arrives.
+    # on_ready fires again on every reconnect and must not load anything.
+    async def setup_hook():
+        logger.info('Attempting to load cogs...')
+        await load_cogs(bot)
+        logger.info('Cogs loading process complete.')
+    bot.setup_hook = setup_hook
+
+    @bot.event
+    async def on_ready():
+        logger.info(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
+        logger.info(f'Discord.py Version: {discord.__version__}')
+        if shard_ids is not None:
+            logger.info(f'Running shard(s) {shard_ids} of {shard_count}')
+        logger.info(f'{bot.user.name} is ready and online!')
+
+    return bot
+
+async def load_cogs(bot):
     for filename in os.listdir('./cogs'):
         if filename.endswith('.py') and not filename.startswith('_'):
             try:
@@ -26,21 +60,73 @@ async def load_cogs():
             except Exception as e:
                 logger.error(f'Failed to load cog {filename}: {e}')
 
-@bot.event
-async def on_ready():
-    logger.info(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
-    logger.info(f'Discord.py Version: {discord.__version__}')
-    logger.info('Attempting to load cogs...')
-    await load_cogs()
-    logger.info('Cogs loading process complete.')
-    logger.info(f'{bot.user.name} is ready and online!')
-
-async def main():
+async def main(bot):
+    # Close cleanly on SIGTERM too, so cogs get to flush buffered XP.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
     async with bot:
         await bot.start(TOKEN)
 
+def run_worker(index, shard_ids, shard_count, database_url):
+    # Each worker gets its own metrics port/file and state snapshot so they don't fight over them.
+    port = int(os.getenv('LEVELING_METRICS_PORT', '0'))
+    if port:
+        os.environ['LEVELING_METRICS_PORT'] = str(port + index)
+    if os.getenv('LEVELING_METRICS_FILE'):
+        root, ext = os.path.splitext(os.environ['LEVELING_METRICS_FILE'])
+        os.environ['LEVELING_METRICS_FILE'] = f'{root}-worker{index}{ext}'
+    if os.getenv('LEVELING_STATE_SNAPSHOT'):
+        os.environ['LEVELING_STATE_SNAPSHOT'] = f"{os.environ['LEVELING_STATE_SNAPSHOT']}.worker{index}"
+    asyncio.run(main(create_bot(database_url, shard_ids, shard_count)))
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def launch(workers, shard_count):
+    """Run `workers` bot processes splitting `shard_count` shards, all writing XP through one state service process."""
+    if shard_count < workers:
+        logger.error(f'LEVELING_SHARD_COUNT ({shard_count}) must be at least LEVELING_WORKERS ({workers})')
+        return
+    ctx = multiprocessing.get_context('spawn')
+    socket_path = STATE_SOCKET or os.path.join(tempfile.mkdtemp(prefix='leveling-'), 'state.sock')
+    ready = ctx.Event()
+    service = ctx.Process(target=run_state_service, args=(socket_path, DATABASE_URL, ready), name='xp-state')
+    service.start()
+    if not ready.wait(60):
+        logger.error('XP state service did not start; giving up.')
+        service.terminate()
+        return
+
+    processes = []
+    for index in range(workers):
+        shard_ids = list(range(index, shard_count, workers))
+        process = ctx.Process(target=run_worker, args=(index, shard_ids, shard_count, f'unix://{socket_path}'), name=f'shard-worker-{index}')
+        process.start()
+        processes.append(process)
+    logger.info(f'Started {workers} worker process(es) for {shard_count} shard(s); XP state service on {socket_path}')
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        # Nothing restarts a dead process, so if any one exits bring the rest down with it.
+        multiprocessing.connection.wait([p.sentinel for p in processes] + [service.sentinel])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers first, so their last XP flush still reaches the state service.
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(30)
+        if service.is_alive():
+            service.terminate()
+        service.join(30)
+
 if __name__ == "__main__":
     if TOKEN is None:
         logger.error("DISCORD_BOT_TOKEN not found set it in the env")
+    elif WORKERS > 1:
+        launch(WORKERS, SHARD_COUNT)
     else:
-        asyncio.run(main())
+        asyncio.run(main(create_bot()))
@@ -1,145 +1,661 @@
 import discord
 from discord.ext import commands
-import aiosqlite
 import math
 import logging
+import os
+import asyncio
+import io
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Literal
+
+from utils.bulk_xp import detect_format, export_xp, import_xp, read_records
+from utils.cache import CooldownIndex, GuildSettingsCache
+from utils.dispatcher import SideEffectDispatcher
+from utils.levels import xp_for_level
+from utils.metrics import InstrumentedStorage, Metrics, MetricsExporter
+from utils.periods import PERIOD_TITLES, PERIODS, bucket_end, bucket_for, period_rows
+from utils.role_sync import RoleSyncJob
+from utils.ranking import LEADERBOARD_PAGE_SIZE, GuildIndex, GuildLeaderboard, GuildRanking
+from utils.storage import open_storage
+from utils.user_state import UserStateStore
+from utils.write_buffer import XPWriteBuffer
+from utils.xp_events import MESSAGE, REACTION, VOICE, XPEvent, XPEventQueue
 
 logger = logging.getLogger('discord')
 
+MAX_COOLDOWN_SECONDS = 3600
+PERIOD_PRUNE_INTERVAL = 3600
+
 import time
-import json
 
 class LevelingSystem(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.db_path = 'd:\\3rd bot\\leveling.db'
-        self.bot.loop.create_task(self.init_db())
-        self.user_cooldowns = {}
-
-    async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER NOT NULL,
-                    guild_id INTEGER NOT NULL,
-                    xp INTEGER DEFAULT 0,
-                    level INTEGER DEFAULT 0,
-                    last_message_timestamp INTEGER DEFAULT 0,
-                    PRIMARY KEY (user_id, guild_id)
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS guild_settings (
-                    guild_id INTEGER PRIMARY KEY,
-                    level_up_channel_id INTEGER,
-                    xp_per_message INTEGER DEFAULT 15,
-                    cooldown_seconds INTEGER DEFAULT 60,
-                    level_roles TEXT DEFAULT '{}',
-                    channel_multipliers TEXT DEFAULT '{}'
-                )
-            ''')
-            await db.commit()
-        logger.info("Leveling system database initialized.")
+        self.metrics = Metrics()
+        storage = open_storage(
+            getattr(bot, 'database_url', 'sqlite:///leveling.db'),
+            sqlite_options={
+                'read_pool_size': int(os.getenv('LEVELING_DB_READERS', '0')),
+                'mmap_size': int(os.getenv('LEVELING_DB_MMAP_SIZE', str(256 * 1024 * 1024))),
+            },
+            postgres_options={
+                'min_size': int(os.getenv('LEVELING_PG_POOL_MIN', '1')),
+                'max_size': int(os.getenv('LEVELING_PG_POOL_MAX', '10')),
+            },
+        )
+        self.storage = InstrumentedStorage(storage, self.metrics)
+        self.settings_cache = GuildSettingsCache(
+            maxsize=int(os.getenv('LEVELING_SETTINGS_CACHE_SIZE', '10000')),
+            ttl=int(os.getenv('LEVELING_SETTINGS_CACHE_TTL', '600')),
+        )
+        self.user_state = None
+        max_users = int(os.getenv('LEVELING_USER_STATE_USERS', '2000000'))
+        if max_users > 0:
+            self.user_state = UserStateStore(max_guilds=int(os.getenv('LEVELING_USER_STATE_GUILDS', '1000')), max_users=max_users,
+                                             snapshot_path=os.getenv('LEVELING_STATE_SNAPSHOT') or None)
+        self.snapshot_interval = float(os.getenv('LEVELING_STATE_SNAPSHOT_INTERVAL', '300'))
+        self._snapshot_task = None
+        flush_interval = float(os.getenv('LEVELING_FLUSH_INTERVAL', '5'))
+        self.xp_buffer = None
+        if flush_interval > 0:
+            self.xp_buffer = XPWriteBuffer(self.storage, flush_interval=flush_interval,
+                                           max_pending=int(os.getenv('LEVELING_FLUSH_MAX_PENDING', '1000')),
+                                           before_flush=self.user_state.mark_dirty if self.user_state is not None else None)
+        self.user_cooldowns = CooldownIndex(horizon=MAX_COOLDOWN_SECONDS)
+        self.rank_index = None
+        if os.getenv('LEVELING_RANK_INDEX', '1') == '1':
+            self.rank_index = GuildIndex(max_guilds=int(os.getenv('LEVELING_RANK_INDEX_GUILDS', '1000')))
+        self.leaderboard_size = int(os.getenv('LEVELING_LEADERBOARD_SIZE', '100'))
+        self.leaderboard_index = None
+        if self.leaderboard_size > 0:
+            self.leaderboard_index = GuildIndex(max_guilds=int(os.getenv('LEVELING_LEADERBOARD_GUILDS', '1000')))
+        self._index_builds = {}
+        self._settings_loads = {}
+        # Warm-up preloads caches for the bot's guilds after login; `ready` is set once it finishes.
+        self.warmup_concurrency = int(os.getenv('LEVELING_WARMUP_CONCURRENCY', '4'))
+        self.ready = asyncio.Event()
+        self.warmed_guilds = 0
+        self._warming = {}
+        # Guilds whose XP events are being applied right now, so pause_guild can wait them out.
+        self._applying = {}
+        # Events for paused or warming guilds, put back on the queue when the guild is released.
+        self._parked = {}
+        self._warmup_task = None
+        self.side_effects = SideEffectDispatcher(
+            self.metrics,
+            window=float(os.getenv('LEVELING_ANNOUNCE_WINDOW', '1.5')),
+            max_pending=int(os.getenv('LEVELING_SIDE_EFFECT_MAX_PENDING', '5000')),
+        )
+        self.xp_events = XPEventQueue(
+            self.apply_xp_events, self.metrics,
+            max_batch=int(os.getenv('LEVELING_EVENT_BATCH', '500')),
+            max_pending=int(os.getenv('LEVELING_EVENT_MAX_PENDING', '10000')),
+        )
+        self.role_syncs = {}
+        self.role_sync_rate = float(os.getenv('LEVELING_ROLE_SYNC_RATE', '1'))
+        self.voice_interval = float(os.getenv('LEVELING_VOICE_INTERVAL', '60'))
+        # Below the queue's own limit, so a big sweep can't crowd out messages.
+        self.voice_max_pending = int(os.getenv('LEVELING_VOICE_MAX_PENDING', '5000'))
+        self._voice_task = None
+        self.xp_periods = []
+        for period in os.getenv('LEVELING_XP_PERIODS', 'daily,weekly,monthly').split(','):
+            period = period.strip()
+            if period in PERIODS:
+                self.xp_periods.append(period)
+            elif period:
+                logger.warning(f"Ignoring unknown XP period '{period}' in LEVELING_XP_PERIODS.")
+        self._prune_task = None
+        self.metrics_exporter = MetricsExporter(
+            self.metrics,
+            port=int(os.getenv('LEVELING_METRICS_PORT', '0')),
+            path=os.getenv('LEVELING_METRICS_FILE') or None,
+            interval=float(os.getenv('LEVELING_METRICS_FILE_INTERVAL', '15')),
+        )
+        self.metrics.add_collector(self.collect_gauges)
+
+    async def cog_load(self):
+        await self.storage.connect()
+        logger.info("Leveling system storage initialized.")
+        if self.snapshotting:
+            self.user_state.load_snapshot()
+            if self.snapshot_interval > 0:
+                self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        if self.xp_buffer is not None:
+            self.xp_buffer.start()
+        await self.metrics_exporter.start()
+        self.xp_events.start()
+        if self.voice_interval > 0:
+            self._voice_task = asyncio.create_task(self._voice_loop())
+        if self.xp_periods:
+            self._prune_task = asyncio.create_task(self._prune_loop())
+        self._warmup_task = asyncio.create_task(self.warm_up())
+
+    async def cog_unload(self):
+        for task in (self._warmup_task, self._voice_task, self._snapshot_task, self._prune_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        # Stopped syncs keep their checkpoint and resume on the next start.
+        for job in self.role_syncs.values():
+            await job.stop()
+        # Apply what's queued before the side effects and XP buffer it feeds are shut down.
+        await self.xp_events.stop()
+        await self.side_effects.stop()
+        await self.metrics_exporter.stop()
+        if self.xp_buffer is not None:
+            await self.xp_buffer.stop()
+        if self.snapshotting:
+            await self.save_state_snapshot()
+        await self.storage.close()
+
+    async def flush_xp(self):
+        if self.xp_buffer is not None:
+            await self.xp_buffer.flush()
+
+    @property
+    def snapshotting(self):
+        return self.user_state is not None and self.user_state.snapshot_path is not None
+
+    async def save_state_snapshot(self):
+        # Flush first: a snapshot may only hold what the database already has.
+        await self.flush_xp()
+        size = await self.user_state.save_snapshot()
+        logger.info(f"Saved user state snapshot of {len(self.user_state):,} users ({size / 1024 / 1024:.1f} MB).")
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save_state_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to save user state snapshot: {e}")
+
+    async def _prune_loop(self):
+        while True:
+            try:
+                await self.prune_period_xp()
+            except Exception as e:
+                logger.error(f"Failed to prune expired period XP: {e}")
+            await asyncio.sleep(PERIOD_PRUNE_INTERVAL)
+
+    async def prune_period_xp(self):
+        # Keep the current and the previous bucket of each period, so a reset never races a late flush.
+        now = time.time()
+        for period in self.xp_periods:
+            await self.storage.prune_period_xp(PERIODS[period], bucket_for(period, now) - 1)
+
+    def collect_gauges(self):
+        gauges = {
+            'settings_cache_hits': self.settings_cache.hits,
+            'settings_cache_misses': self.settings_cache.misses,
+            'settings_cache_size': len(self.settings_cache),
+            'cooldown_index_size': len(self.user_cooldowns),
+            'cooldown_index_checks': self.user_cooldowns.checks,
+            'cooldown_index_rejected': self.user_cooldowns.rejected,
+            'side_effects_pending': self.side_effects.pending,
+            'xp_events_pending': len(self.xp_events),
+            'xp_events_parked': sum(len(events) for events in self._parked.values()),
+            'ready': int(self.ready.is_set()),
+            'warmed_guilds': self.warmed_guilds,
+        }
+        if self.xp_buffer is not None:
+            gauges['xp_buffer_pending'] = len(self.xp_buffer)
+            gauges['xp_buffer_flushes'] = self.xp_buffer.flushes
+            gauges['xp_buffer_rows_flushed'] = self.xp_buffer.rows_flushed
+        if self.user_state is not None:
+            gauges['user_state_users'] = len(self.user_state)
+            gauges['user_state_guilds'] = self.user_state.guilds
+            gauges['user_state_bytes'] = self.user_state.nbytes()
+            gauges['user_state_hits'] = self.user_state.hits
+            gauges['user_state_misses'] = self.user_state.misses
+        if self.rank_index is not None:
+            gauges['rank_index_guilds'] = len(self.rank_index)
+        if self.leaderboard_index is not None:
+            gauges['leaderboard_guilds'] = len(self.leaderboard_index)
+        return gauges
+
+    @asynccontextmanager
+    async def pause_guild(self, guild_id):
+        """Hold back the guild's XP events inside the block, once any already being applied are done."""
+        while (busy := self._warming.get(guild_id) or self._applying.get(guild_id)) is not None:
+            await asyncio.wait([busy])
+        pause = self._warming[guild_id] = asyncio.get_running_loop().create_future()
+        try:
+            yield
+        finally:
+            del self._warming[guild_id]
+            pause.set_result(None)
+            self._release_parked(guild_id)
+
+    def _release_parked(self, guild_id):
+        events = self._parked.pop(guild_id, None)
+        if events:
+            self.xp_events.put_back(events)
+
+    def invalidate_guild_xp(self, guild_id):
+        # For bulk writes that bypass update_user_data.
+        if self.user_state is not None:
+            self.user_state.invalidate(guild_id)
+        if self.rank_index is not None:
+            self.rank_index.invalidate(guild_id)
+        if self.leaderboard_index is not None:
+            self.leaderboard_index.invalidate(guild_id)
+
+    async def warm_up(self):
+        await self.bot.wait_until_ready()
+        try:
+            await self.resume_role_syncs()
+        except Exception as e:
+            logger.error(f"Could not resume level role syncs: {e}")
+        if self.warmup_concurrency <= 0:
+            self.ready.set()
+            return
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        semaphore = asyncio.Semaphore(self.warmup_concurrency)
+
+        async def warm(guild_id):
+            async with semaphore:
+                if guild_id in self._warming:
+                    # Paused for an import, which invalidates the caches anyway.
+                    return
+                # Messages for this guild are held back instead of racing the warm-up to the database.
+                task = self._warming[guild_id] = asyncio.ensure_future(self.warm_guild(guild_id))
+                try:
+                    await task
+                finally:
+                    self._warming.pop(guild_id, None)
+                    self._release_parked(guild_id)
+
+        await asyncio.gather(*(warm(guild.id) for guild in self.bot.guilds))
+        self.ready.set()
+        logger.info(f"Leveling caches warmed for {self.warmed_guilds} guild(s) in {loop.time() - started:.1f}s.")
+
+    async def warm_guild(self, guild_id):
+        try:
+            settings = await self.get_guild_settings(guild_id)
+            # Only users still inside the cooldown can have a message rejected, so only they are loaded.
+            now = int(time.time())
+            for user_id, last_message_timestamp in await self.storage.recent_users(guild_id, now - settings.cooldown_seconds):
+                self.user_cooldowns.record((guild_id, user_id), last_message_timestamp)
+            if self.leaderboard_index is not None and len(self.leaderboard_index) < self.leaderboard_index.max_guilds:
+                await self.get_guild_leaderboard(guild_id)
+            self.warmed_guilds += 1
+        except Exception as e:
+            logger.warning(f"Could not warm leveling caches for guild {guild_id}: {e}")
+
+    async def start_role_sync(self, guild, last_user_id=0, granted=0, restart=False):
+        job = self.role_syncs.get(guild.id)
+        if job is not None and job.running:
+            if not restart:
+                return job
+            await job.stop()
+            last_user_id, granted = 0, 0
+        await self.flush_xp()
+        settings = await self.get_guild_settings(guild.id)
+        job = self.role_syncs[guild.id] = RoleSyncJob(guild, self.storage, settings, self.side_effects.request,
+                                                      rate=self.role_sync_rate, last_user_id=last_user_id, granted=granted)
+        job.start()
+        return job
+
+    async def resume_role_syncs(self):
+        for guild_id, last_user_id, granted in await self.storage.pending_role_syncs():
+            # Other shards own the guilds this process can't see.
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None:
+                logger.info(f"Resuming level role sync for guild {guild_id} after user {last_user_id}.")
+                await self.start_role_sync(guild, last_user_id, granted)
 
     async def get_guild_settings(self, guild_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT level_up_channel_id, xp_per_message, cooldown_seconds, level_roles, channel_multipliers FROM guild_settings WHERE guild_id = ?", (guild_id,)) as cursor:
-                settings = await cursor.fetchone()
-                if settings:
-                    return settings[0], settings[1], settings[2], json.loads(settings[3] or '{}'), json.loads(settings[4] or '{}')
-            await db.execute("INSERT OR IGNORE INTO guild_settings (guild_id) VALUES (?)", (guild_id,))
-            await db.commit()
-            return None, 15, 60, {}, {}
+        settings = self.settings_cache.get(guild_id)
+        if settings is not None:
+            return settings
+        # One load per guild at a time, however many messages miss the cache together.
+        load = self._settings_loads.get(guild_id)
+        if load is None:
+            load = asyncio.ensure_future(self._load_guild_settings(guild_id))
+            self._settings_loads[guild_id] = load
+            load.add_done_callback(lambda _: self._settings_loads.pop(guild_id, None) if self._settings_loads.get(guild_id) is load else None)
+        return await asyncio.shield(load)
+
+    async def _load_guild_settings(self, guild_id):
+        generation = self.settings_cache.generation(guild_id)
+        settings = await self.storage.get_guild_settings(guild_id)
+        self.settings_cache.put(guild_id, settings, generation)
+        return settings
+
+    def invalidate_guild_settings(self, guild_id):
+        # Later misses start a fresh load instead of joining one that may have read the old settings.
+        self.settings_cache.invalidate(guild_id)
+        self._settings_loads.pop(guild_id, None)
 
     async def get_user_data(self, user_id, guild_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT xp, level, last_message_timestamp FROM users WHERE user_id = ? AND guild_id = ?", (user_id, guild_id)) as cursor:
-                return await cursor.fetchone()
+        if self.user_state is not None:
+            row = self.user_state.get(guild_id, user_id)
+            if row is not None:
+                return row
+        if self.xp_buffer is not None:
+            pending = self.xp_buffer.get(guild_id, user_id)
+            if pending is not None:
+                return pending
+        row = await self.storage.get_user(guild_id, user_id)
+        if row is not None and self.user_state is not None:
+            self.user_state.put(guild_id, user_id, *row)
+        return row
 
-    async def update_user_data(self, user_id, guild_id, xp, level, last_message_timestamp):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("INSERT OR REPLACE INTO users (user_id, guild_id, xp, level, last_message_timestamp) VALUES (?, ?, ?, ?, ?)", 
-                             (user_id, guild_id, xp, level, last_message_timestamp))
-            await db.commit()
+    async def update_user_data(self, user_id, guild_id, xp, level, last_message_timestamp, gained=0, earned_at=None):
+        # `gained` XP earned at `earned_at` also counts towards the daily/weekly/monthly totals.
+        periods = period_rows(self.xp_periods, guild_id, user_id, gained, earned_at) if gained > 0 else []
+        if self.user_state is not None:
+            self.user_state.put(guild_id, user_id, xp, level, last_message_timestamp)
+        if self.rank_index is not None:
+            self.rank_index.update(guild_id, user_id, xp, level)
+        if self.leaderboard_index is not None:
+            self.leaderboard_index.update(guild_id, user_id, xp, level)
+        if self.xp_buffer is not None:
+            self.xp_buffer.put(guild_id, user_id, xp, level, last_message_timestamp)
+            for row in periods:
+                self.xp_buffer.add_period_xp(*row)
+            return
+        if self.user_state is not None:
+            self.user_state.mark_dirty()
+        if periods:
+            await self.storage.upsert_users([(guild_id, user_id, xp, level, last_message_timestamp)], periods)
+        else:
+            await self.storage.upsert_user(guild_id, user_id, xp, level, last_message_timestamp)
+
+    async def _get_indexed(self, index, guild_id, build_fn):
+        value = index.get(guild_id)
+        if value is not None:
+            return value
+        key = (id(index), guild_id)
+        build = self._index_builds.get(key)
+        if build is None:
+            build = asyncio.ensure_future(self._build_indexed(index, guild_id, build_fn))
+            self._index_builds[key] = build
+            build.add_done_callback(lambda _: self._index_builds.pop(key, None))
+        return await asyncio.shield(build)
+
+    async def _build_indexed(self, index, guild_id, build_fn):
+        index.begin_build(guild_id)
+        try:
+            await self.flush_xp()
+            value = await build_fn(guild_id)
+        except BaseException:
+            index.invalidate(guild_id)
+            raise
+        index.put(guild_id, value)
+        return value
+
+    async def get_guild_ranking(self, guild_id):
+        if self.rank_index is None:
+            return None
+        return await self._get_indexed(self.rank_index, guild_id, self._load_guild_ranking)
+
+    async def _load_guild_ranking(self, guild_id):
+        return GuildRanking(await self.storage.guild_xp(guild_id))
+
+    async def get_guild_leaderboard(self, guild_id):
+        if self.leaderboard_index is None:
+            return None
+        return await self._get_indexed(self.leaderboard_index, guild_id, self._load_guild_leaderboard)
+
+    async def _load_guild_leaderboard(self, guild_id):
+        return GuildLeaderboard(await self.storage.top_users(guild_id, self.leaderboard_size), self.leaderboard_size)
+
+    async def get_leaderboard_page(self, guild, page, period='all'):
+        # Returns (embed, page, page_count), or None when nobody is ranked yet.
+        if period != 'all':
+            return await self.get_period_leaderboard_page(guild, page, period)
+        leaderboard = await self.get_guild_leaderboard(guild.id)
+        if leaderboard is not None and leaderboard.complete:
+            total = len(leaderboard)
+        else:
+            # The cache only holds the top LEVELING_LEADERBOARD_SIZE users, so the count comes
+            # from the rank index, which is kept current on every XP update.
+            ranking = await self.get_guild_ranking(guild.id)
+            if ranking is not None:
+                total = ranking.total
+            else:
+                await self.flush_xp()
+                total = await self.storage.count_ranked(guild.id)
+        if not total:
+            return None
+        page_count = -(-total // LEADERBOARD_PAGE_SIZE)
+        page = min(page, page_count - 1)
+        if leaderboard is None or (not leaderboard.complete and (page + 1) * LEADERBOARD_PAGE_SIZE > len(leaderboard)):
+            # Pages past the cached ones are read from the database.
+            await self.flush_xp()
+            rows = await self.storage.top_users(guild.id, LEADERBOARD_PAGE_SIZE, page * LEADERBOARD_PAGE_SIZE)
+            entries = [(page * LEADERBOARD_PAGE_SIZE + i + 1, user_id, xp, level) for i, (user_id, xp, level) in enumerate(rows)]
+            return self.render_leaderboard_page(guild, entries, page, page_count), page, page_count
+        # Rendered pages show the page count, so one rendered for a different count is stale.
+        cached = leaderboard.pages.get(page)
+        if cached is None or cached[0] != page_count:
+            cached = leaderboard.pages[page] = (page_count, self.render_leaderboard_page(guild, leaderboard.page(page), page, page_count))
+        return cached[1], page, page_count
+
+    async def get_period_leaderboard_page(self, guild, page, period):
+        # Served straight from the period totals' index, after flushing so recent XP shows up.
+        await self.flush_xp()
+        code = PERIODS[period]
+        bucket = bucket_for(period, time.time())
+        total = await self.storage.period_count(guild.id, code, bucket)
+        if not total:
+            return None
+        page_count = -(-total // LEADERBOARD_PAGE_SIZE)
+        page = min(page, page_count - 1)
+        rows = await self.storage.period_top(guild.id, code, bucket, LEADERBOARD_PAGE_SIZE, page * LEADERBOARD_PAGE_SIZE)
+        embed = discord.Embed(
+            title=f"🏆 {PERIOD_TITLES[period]}'s Leaderboard for {guild.name}",
+            color=discord.Color.gold()
+        )
+        lines = [f"`#{page * LEADERBOARD_PAGE_SIZE + i + 1}` <@{user_id}> — **XP {PERIOD_TITLES[period].lower()}:** `{xp:,}`"
+                 for i, (user_id, xp) in enumerate(rows)]
+        lines.append(f"\nResets <t:{bucket_end(period, bucket)}:R>.")
+        embed.description = "\n".join(lines)
+        embed.set_footer(text=f"Page {page + 1}/{page_count} · Users ranked by XP earned {PERIOD_TITLES[period].lower()} in {guild.name}")
+        return embed, page, page_count
+
+    def render_leaderboard_page(self, guild, entries, page, page_count):
+        # Mentions render client-side, so no member lookups are needed to build a page.
+        embed = discord.Embed(
+            title=f"🏆 Leaderboard for {guild.name}",
+            color=discord.Color.gold()
+        )
+        embed.description = "\n".join(f"`#{position}` <@{user_id}> — **Level:** `{level}` | **XP:** `{xp:,}`"
+                                      for position, user_id, xp, level in entries)
+        embed.set_footer(text=f"Page {page + 1}/{page_count} · Users ranked by XP in {guild.name}")
+        return embed
 
     def calculate_xp_for_level(self, level):
-        if level < 0: return 0
-        return int(5 * (level ** 2) + 50 * level + 100)
+        return xp_for_level(level)
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot or not message.guild:
             return
+        self.metrics.inc('messages_seen')
+        self.xp_events.put(XPEvent(MESSAGE, message.guild.id, message.author.id, message.channel.id, int(time.time()),
+                                   member=message.author, channel=message.channel))
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction, user):
+        # Only messages still in the bot's cache; fetching the rest would cost an API call per reaction.
+        message = reaction.message
+        author = message.author
+        if not message.guild or user.bot or author.bot or user.id == author.id or not isinstance(author, discord.Member):
+            return
+        self.xp_events.put(XPEvent(REACTION, message.guild.id, author.id, message.channel.id, int(time.time()),
+                                   member=author, channel=message.channel))
 
-        user_id = message.author.id
-        guild_id = message.guild.id
-        channel_id = message.channel.id
-        current_time = int(time.time())
+    async def _voice_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.voice_interval)
+            try:
+                await self.sweep_voice(self.voice_interval / 60)
+            except Exception as e:
+                logger.error(f"Error sweeping voice channels: {e}")
 
-        level_up_channel_id, base_xp_to_add, cooldown_seconds, level_roles_config, channel_multipliers_config = await self.get_guild_settings(guild_id)
+    async def sweep_voice(self, minutes):
+        # One pass over cached voice states per interval instead of tracking joins and leaves.
+        now = int(time.time())
+        for guild in self.bot.guilds:
+            settings = None
+            for channel in guild.voice_channels:
+                if channel == guild.afk_channel:
+                    continue
+                listeners = [m for m in channel.members if not m.bot and m.voice and not (m.voice.deaf or m.voice.self_deaf)]
+                # Sitting alone in a channel doesn't count.
+                if len(listeners) < 2:
+                    continue
+                if settings is None:
+                    settings = await self.get_guild_settings(guild.id)
+                if settings.voice_xp_per_minute <= 0:
+                    break
+                for member in listeners:
+                    if not self.xp_events.put(XPEvent(VOICE, guild.id, member.id, channel.id, now, units=minutes,
+                                                      member=member, channel=channel), max_pending=self.voice_max_pending):
+                        # Every later tick would be dropped too.
+                        return
 
-        xp_to_add = base_xp_to_add
-        channel_multiplier = channel_multipliers_config.get(str(channel_id))
-        if channel_multiplier is not None:
-            xp_to_add = int(base_xp_to_add * channel_multiplier)
+    async def apply_xp_events(self, events):
+        by_guild = {}
+        for event in events:
+            by_guild.setdefault(event.guild_id, []).append(event)
+        for guild_id, guild_events in by_guild.items():
+            if guild_id in self._warming:
+                # Waiting here would hold up every other guild in the batch.
+                self._parked.setdefault(guild_id, []).extend(guild_events)
+                self.metrics.inc('xp_events_parked', len(guild_events))
+                continue
+            applying = self._applying[guild_id] = asyncio.get_running_loop().create_future()
+            try:
+                await self._apply_guild_events(guild_id, guild_events)
+            finally:
+                del self._applying[guild_id]
+                applying.set_result(None)
 
-        user_data = await self.get_user_data(user_id, guild_id)
-        if not user_data:
-            await self.update_user_data(user_id, guild_id, 0, 0, 0)
-            xp, current_level, last_msg_ts = 0, 0, 0
-        else:
-            xp, current_level, last_msg_ts = user_data
+    async def _apply_guild_events(self, guild_id, guild_events):
+        with self.metrics.timer('stage', 'settings'):
+            settings = await self.get_guild_settings(guild_id)
+        guild_events = [event for event in guild_events if not self._rejected_early(event, settings)]
+        if not guild_events:
+            return
+        with self.metrics.timer('stage', 'user_fetch'):
+            users = await self.get_users_data(guild_id, {event.user_id for event in guild_events})
+        for event in guild_events:
+            await self.apply_xp_event(event, settings, users)
+
+    def _cooldown_key(self, event):
+        return (event.guild_id, event.user_id) if event.source == MESSAGE else (event.guild_id, event.user_id, event.source)
+
+    def _rejected_early(self, event, settings):
+        # Drop what can't earn anything before any user rows are fetched.
+        if self.xp_for_event(event, settings) <= 0:
+            return True
+        if event.source != VOICE and self.user_cooldowns.check(self._cooldown_key(event), event.timestamp, settings.cooldown_seconds):
+            self.metrics.inc('cooldown_rejects_early')
+            return True
+        return False
+
+    def xp_for_event(self, event, settings):
+        if event.source == MESSAGE:
+            return settings.xp_for_channel(event.channel_id)
+        if event.source == REACTION:
+            return settings.reaction_xp
+        return int(settings.voice_xp_per_minute * event.units)
 
-        if current_time - last_msg_ts < cooldown_seconds:
+    async def get_users_data(self, guild_id, user_ids):
+        users = {}
+        for user_id in user_ids:
+            row = self.user_state.get(guild_id, user_id) if self.user_state is not None else None
+            if row is None and self.xp_buffer is not None:
+                row = self.xp_buffer.get(guild_id, user_id)
+            if row is not None:
+                users[user_id] = row
+        missing = [user_id for user_id in user_ids if user_id not in users]
+        if missing:
+            found = await self.storage.get_users(guild_id, missing)
+            if self.user_state is not None:
+                for user_id, row in found.items():
+                    self.user_state.put(guild_id, user_id, *row)
+            users.update(found)
+        return users
+
+    async def apply_xp_event(self, event, settings, users):
+        # `users` holds the batch's view of each user and is updated in place.
+        user_id = event.user_id
+        guild_id = event.guild_id
+        xp, current_level, last_msg_ts = users.get(user_id, (0, 0, 0))
+        timestamp = last_msg_ts
+        if event.source == MESSAGE:
+            cooldown_key = (guild_id, user_id)
+            self.user_cooldowns.record(cooldown_key, last_msg_ts)
+            if event.timestamp - last_msg_ts < settings.cooldown_seconds:
+                self.metrics.inc('cooldown_rejects')
+                return
+            # Only messages move the stored timestamp, so voice and reactions never put chat on cooldown.
+            timestamp = event.timestamp
+        elif event.source != VOICE and self.user_cooldowns.check(self._cooldown_key(event), event.timestamp, settings.cooldown_seconds):
+            # The early check ran before this batch's earlier awards were recorded.
+            self.metrics.inc('cooldown_rejects')
             return
+        xp_to_add = self.xp_for_event(event, settings)
 
         xp += xp_to_add
-        await self.update_user_data(user_id, guild_id, xp, current_level, current_time)
+        new_level = current_level
+        while xp >= self.calculate_xp_for_level(new_level + 1):
+            new_level += 1
 
-        xp_needed_for_next_level = self.calculate_xp_for_level(current_level + 1)
-        
-        if xp >= xp_needed_for_next_level:
-            new_level = current_level + 1
-            while xp >= self.calculate_xp_for_level(new_level +1 ):
-                 new_level += 1
-            
-            await self.update_user_data(user_id, guild_id, xp, new_level, current_time)
-            
-            level_up_message = f'🎉 Congratulations {message.author.mention}, you have reached **Level {new_level}**! 🎉'
-            target_channel = None
-            if level_up_channel_id:
-                target_channel = self.bot.get_channel(level_up_channel_id)
-            
-            if target_channel:
-                try:
-                    await target_channel.send(level_up_message)
-                except discord.Forbidden:
-                    await message.channel.send(f"{level_up_message} (Couldn't send to configured channel.)")
-                    logger.warning(f"Could not send level up message to {level_up_channel_id} in guild {guild_id} due to permissions.")
-                except discord.HTTPException:
-                    await message.channel.send(f"{level_up_message} (Couldn't send to configured channel.)")
-                    logger.warning(f"Could not send level up message to {level_up_channel_id} in guild {guild_id} due to HTTP error.")
-            else:
-                await message.channel.send(level_up_message)
-            logger.info(f'{message.author.name} (ID: {user_id}) leveled up to {new_level} in guild {message.guild.name} (ID: {guild_id}). XP: {xp}')
+        with self.metrics.timer('stage', 'write'):
+            await self.update_user_data(user_id, guild_id, xp, new_level, timestamp, gained=xp_to_add, earned_at=event.timestamp)
+        users[user_id] = (xp, new_level, timestamp)
+        if event.source != VOICE:
+            self.user_cooldowns.record(self._cooldown_key(event), event.timestamp)
+        self.metrics.inc('xp_awarded', xp_to_add)
 
-            try:
-                role_to_add_id = level_roles_config.get(str(new_level))
-                if role_to_add_id:
-                    role = message.guild.get_role(int(role_to_add_id))
-                    if role and role <= message.guild.me.top_role:
-                        await message.author.add_roles(role, reason=f"Reached Level {new_level}")
-                        logger.info(f"Assigned role {role.name} to {message.author.name} for reaching level {new_level}.")
-                    elif role:
-                        logger.warning(f"Cannot assign role {role.name} to {message.author.name} - Bot's role is too low.")
-                    else:
-                        logger.warning(f"Role ID {role_to_add_id} for level {new_level} not found in guild {guild_id}.")
-            except Exception as e:
-                logger.error(f"Error assigning role for level {new_level} to {message.author.name}: {e}")
+        if new_level > current_level and event.member is not None:
+            self.metrics.inc('level_ups')
+            # Both only enqueue; the Discord calls happen on the side-effect dispatcher.
+            with self.metrics.timer('stage', 'announce'):
+                self.announce_level_up(event.member, event.channel, settings, new_level)
+            logger.info(f'{event.member.name} (ID: {user_id}) leveled up to {new_level} in guild {event.member.guild.name} (ID: {guild_id}). XP: {xp}')
+            with self.metrics.timer('stage', 'roles'):
+                self.assign_level_roles(event.member, settings, current_level, new_level)
+
+    def announce_level_up(self, member, channel, settings, new_level):
+        level_up_message = f'🎉 Congratulations {member.mention}, you have reached **Level {new_level}**! 🎉'
+        target_channel = None
+        if settings.level_up_channel_id:
+            target_channel = self.bot.get_channel(settings.level_up_channel_id)
+
+        if target_channel:
+            self.side_effects.announce(target_channel, level_up_message, fallback=channel)
+        else:
+            self.side_effects.announce(channel, level_up_message)
+
+    def assign_level_roles(self, member, settings, old_level, new_level):
+        # Every level passed counts, so jumping several levels at once doesn't skip a role.
+        guild = member.guild
+        for role_to_add_id in settings.roles_between(old_level, new_level):
+            role = guild.get_role(role_to_add_id)
+            if role and role <= guild.me.top_role:
+                self.side_effects.grant_role(member, role, reason=f"Reached Level {new_level}")
+            elif role:
+                logger.warning(f"Cannot assign role {role.name} to {member.name} - Bot's role is too low.")
+            else:
+                logger.warning(f"Role ID {role_to_add_id} for level {new_level} not found in guild {guild.id}.")
 
     @commands.hybrid_command(name="rank", description="Check your current rank and XP.")
-    async def rank(self, ctx: commands.Context, member: discord.Member = None):
+    async def rank(self, ctx: commands.Context, member: discord.Member = None,
+                   period: Literal['all', 'daily', 'weekly', 'monthly'] = 'all'):
         target_member = member or ctx.author
+        if period != 'all':
+            await self.send_period_rank(ctx, target_member, period)
+            return
 
         user_data = await self.get_user_data(target_member.id, ctx.guild.id)
         if not user_data or user_data[0] == 0:
@@ -148,11 +664,13 @@ class LevelingSystem(commands.Cog):
 
         xp, level, _ = user_data 
 
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT COUNT(*) FROM users WHERE guild_id = ? AND xp > ?", (ctx.guild.id, xp)) as cursor:
-                rank = (await cursor.fetchone())[0] + 1
-            async with db.execute("SELECT COUNT(*) FROM users WHERE guild_id = ? AND xp > 0", (ctx.guild.id,)) as cursor:
-                total_ranked_users = (await cursor.fetchone())[0]
+        ranking = await self.get_guild_ranking(ctx.guild.id)
+        if ranking is not None:
+            rank = ranking.rank(xp)
+            total_ranked_users = ranking.total
+        else:
+            await self.flush_xp()
+            rank, total_ranked_users = await self.storage.rank(ctx.guild.id, xp)
 
         xp_for_current_level = self.calculate_xp_for_level(level)
         xp_for_next_level = self.calculate_xp_for_level(level + 1)
@@ -186,59 +704,100 @@ class LevelingSystem(commands.Cog):
 
         await ctx.send(embed=embed)
 
-    @commands.hybrid_command(name="leaderboard", description="Shows the server's top 10 users.")
-    @commands.cooldown(1, 30, commands.BucketType.guild)
-    async def leaderboard(self, ctx: commands.Context):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT user_id, xp, level FROM users WHERE guild_id = ? AND xp > 0 ORDER BY xp DESC LIMIT 10", (ctx.guild.id,)) as cursor:
-                top_users = await cursor.fetchall()
-
-        if not top_users:
-            await ctx.send("The leaderboard is currently empty. Get chatting to rank up!", ephemeral=True)
+    async def send_period_rank(self, ctx, member, period):
+        if period not in self.xp_periods:
+            await ctx.send(f"{period.capitalize()} XP isn't tracked on this bot.", ephemeral=True)
             return
+        await self.flush_xp()
+        bucket = bucket_for(period, time.time())
+        result = await self.storage.period_rank(ctx.guild.id, PERIODS[period], bucket, member.id)
+        if result is None:
+            await ctx.send(f"{member.mention} hasn't earned any XP {PERIOD_TITLES[period].lower()}.", ephemeral=True)
+            return
+        xp, rank, total_ranked_users = result
 
         embed = discord.Embed(
-            title=f"🏆 Leaderboard for {ctx.guild.name}",
-            color=discord.Color.gold()
+            title=f"{member.display_name}'s Leveling Stats — {PERIOD_TITLES[period]}",
+            color=member.color if member.color != discord.Color.default() else discord.Color.blue()
         )
-
-        for i, (user_id, xp, level) in enumerate(top_users):
-            member = ctx.guild.get_member(user_id)
-            name = member.mention if member else f"User ID: {user_id} (Left Server)"
-            embed.add_field(name=f"`#{i+1}` {name}", value=f"**Level:** `{level}` | **XP:** `{xp:,}`", inline=False)
-        
-        embed.set_footer(text=f"Top 10 users by XP in {ctx.guild.name}")
+        embed.set_thumbnail(url=member.avatar.url if member.avatar else member.default_avatar.url)
+        embed.add_field(name="✨ XP", value=f"`{xp:,}`", inline=True)
+        embed.add_field(name="🏆 Rank", value=f"`#{rank}/{total_ranked_users}`", inline=True)
+        embed.add_field(name="⏳ Resets", value=f"<t:{bucket_end(period, bucket)}:R>", inline=True)
+        embed.set_footer(text=f"Requested by {ctx.author.display_name}", icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
         await ctx.send(embed=embed)
 
+    @commands.hybrid_command(name="leaderboard", description="Shows the server's leaderboard, one page at a time.")
+    @commands.guild_only()
+    async def leaderboard(self, ctx: commands.Context, page: commands.Range[int, 1, None] = 1,
+                          period: Literal['all', 'daily', 'weekly', 'monthly'] = 'all'):
+        if period != 'all' and period not in self.xp_periods:
+            await ctx.send(f"{period.capitalize()} XP isn't tracked on this bot.", ephemeral=True)
+            return
+        result = await self.get_leaderboard_page(ctx.guild, page - 1, period)
+        if result is None:
+            await ctx.send("The leaderboard is currently empty. Get chatting to rank up!", ephemeral=True)
+            return
+
+        embed, page_index, page_count = result
+        view = LeaderboardView(self, ctx.author.id, page_index, page_count, period)
+        view.message = await ctx.send(embed=embed, view=view, allowed_mentions=discord.AllowedMentions.none())
+
+    @commands.hybrid_command(name="levelstats", description="Shows leveling hot-path latency and counters (bot owner only).")
+    @commands.is_owner()
+    async def levelstats(self, ctx: commands.Context):
+        embed = discord.Embed(title="📈 Leveling System Stats", color=discord.Color.dark_teal())
+
+        counters = {**self.metrics.counters, **self.metrics.gauges()}
+        uptime = counters.pop('uptime_seconds')
+        counter_lines = [f"{name.replace('_', ' ')}: `{value:,}`" for name, value in sorted(counters.items())]
+        embed.description = "\n".join(counter_lines) or "No activity recorded yet."
+
+        for family, title in (('stage', "⏱️ on_message stages"), ('db', "🗄️ Storage calls")):
+            lines = []
+            for (hist_family, label), histogram in sorted(self.metrics.histograms.items()):
+                if hist_family != family or not histogram.count:
+                    continue
+                p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+                lines.append(f"`{label}` n={histogram.count:,} avg={histogram.sum / histogram.count * 1000:.2f}ms "
+                             f"p50≤{p50:g}ms p95≤{p95:g}ms p99≤{p99:g}ms")
+            if lines:
+                embed.add_field(name=title, value="\n".join(lines)[:1024], inline=False)
+
+        embed.set_footer(text=f"Uptime {uptime / 3600:.1f}h · Percentiles are histogram bucket bounds")
+        await ctx.send(embed=embed, ephemeral=True)
+
     @commands.hybrid_group(name="levelconfig", description="Configure leveling system settings.", fallback="show")
     @commands.has_permissions(manage_guild=True)
     @commands.guild_only()
     async def levelconfig(self, ctx: commands.Context):
         if ctx.invoked_subcommand is None:
-            level_up_channel_id, xp_per_message, cooldown_seconds, level_roles_config, channel_multipliers_config = await self.get_guild_settings(ctx.guild.id)
-            channel_mention = f"<#{level_up_channel_id}>" if level_up_channel_id else "Not Set (Defaults to command channel)"
+            settings = await self.get_guild_settings(ctx.guild.id)
+            channel_mention = f"<#{settings.level_up_channel_id}>" if settings.level_up_channel_id else "Not Set (Defaults to command channel)"
             
             embed = discord.Embed(title=f"Leveling Configuration for {ctx.guild.name}", color=discord.Color.orange())
             embed.add_field(name="📢 Level Up Channel", value=channel_mention, inline=False)
-            embed.add_field(name="✨ Base XP Per Message", value=f"`{xp_per_message}` XP", inline=True)
-            embed.add_field(name="⏱️ Cooldown", value=f"`{cooldown_seconds}` seconds", inline=True)
+            embed.add_field(name="✨ Base XP Per Message", value=f"`{settings.xp_per_message}` XP", inline=True)
+            embed.add_field(name="⏱️ Cooldown", value=f"`{settings.cooldown_seconds}` seconds", inline=True)
+            embed.add_field(name="🎙️ Voice XP", value=f"`{settings.voice_xp_per_minute}` XP/minute" if settings.voice_xp_per_minute else "Off", inline=True)
+            embed.add_field(name="💬 Reaction XP", value=f"`{settings.reaction_xp}` XP per reaction received" if settings.reaction_xp else "Off", inline=True)
             
             roles_str = "No level roles configured."
-            if level_roles_config:
+            if settings.level_roles:
                 roles_list = []
-                for lvl, role_id_str in sorted(level_roles_config.items(), key=lambda item: int(item[0])):
-                    role = ctx.guild.get_role(int(role_id_str))
-                    roles_list.append(f"Level `{lvl}` → {role.mention if role else f'`Role ID: {role_id_str} (Not Found)`'}")
+                for lvl, role_id in settings.level_roles:
+                    role = ctx.guild.get_role(role_id)
+                    roles_list.append(f"Level `{lvl}` → {role.mention if role else f'`Role ID: {role_id} (Not Found)`'}")
                 if roles_list:
                     roles_str = "\n".join(roles_list)
             embed.add_field(name="🏅 Level Roles", value=roles_str, inline=False)
 
             multipliers_str = "No channel-specific XP multipliers configured."
-            if channel_multipliers_config:
+            if settings.channel_multipliers:
                 multi_list = []
-                for ch_id_str, multiplier in sorted(channel_multipliers_config.items(), key=lambda item: float(item[1] if isinstance(item[1], (int, float)) else 1.0), reverse=True):
-                    channel_obj = ctx.guild.get_channel(int(ch_id_str))
-                    multi_list.append(f"{channel_obj.mention if channel_obj else f'`Channel ID: {ch_id_str} (Not Found)`'}: `{multiplier}x` XP")
+                for ch_id, multiplier in sorted(settings.channel_multipliers.items(), key=lambda item: item[1], reverse=True):
+                    channel_obj = ctx.guild.get_channel(ch_id)
+                    multi_list.append(f"{channel_obj.mention if channel_obj else f'`Channel ID: {ch_id} (Not Found)`'}: `{multiplier}x` XP")
                 if multi_list:
                     multipliers_str = "\n".join(multi_list)
             embed.add_field(name="💸 Channel XP Multipliers", value=multipliers_str, inline=False)
@@ -249,31 +808,49 @@ class LevelingSystem(commands.Cog):
     @levelconfig.command(name="setchannel", description="Sets the channel for level-up announcements.")
     @commands.has_permissions(manage_guild=True)
     async def setlevelchannel(self, ctx: commands.Context, channel: discord.TextChannel = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            if channel:
-                await db.execute("INSERT INTO guild_settings (guild_id, level_up_channel_id) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET level_up_channel_id = excluded.level_up_channel_id", (ctx.guild.id, channel.id))
-                await ctx.send(f"✅ Level up announcements will now be sent to {channel.mention}.")
-            else:
-                await db.execute("INSERT INTO guild_settings (guild_id, level_up_channel_id) VALUES (?, NULL) ON CONFLICT(guild_id) DO UPDATE SET level_up_channel_id = NULL", (ctx.guild.id,))
-                await ctx.send("✅ Level up announcements channel has been reset. Announcements will be in the channel where the user levels up.")
-            await db.commit()
+        if channel:
+            await self.storage.update_guild_settings(ctx.guild.id, level_up_channel_id=channel.id)
+            self.invalidate_guild_settings(ctx.guild.id)
+            await ctx.send(f"✅ Level up announcements will now be sent to {channel.mention}.")
+        else:
+            await self.storage.update_guild_settings(ctx.guild.id, level_up_channel_id=None)
+            self.invalidate_guild_settings(ctx.guild.id)
+            await ctx.send("✅ Level up announcements channel has been reset. Announcements will be in the channel where the user levels up.")
 
     @levelconfig.command(name="setxp", description="Sets the amount of XP gained per message.")
     @commands.has_permissions(manage_guild=True)
     async def setxppermessage(self, ctx: commands.Context, amount: commands.Range[int, 1, 1000]):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("INSERT INTO guild_settings (guild_id, xp_per_message) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET xp_per_message = excluded.xp_per_message", (ctx.guild.id, amount))
-            await db.commit()
+        await self.storage.update_guild_settings(ctx.guild.id, xp_per_message=amount)
+        self.invalidate_guild_settings(ctx.guild.id)
         await ctx.send(f"✅ XP gained per message set to `{amount}`.")
 
     @levelconfig.command(name="setcooldown", description="Sets the cooldown (in seconds) for gaining XP.")
     @commands.has_permissions(manage_guild=True)
-    async def setcooldown(self, ctx: commands.Context, seconds: commands.Range[int, 0, 3600]):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("INSERT INTO guild_settings (guild_id, cooldown_seconds) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET cooldown_seconds = excluded.cooldown_seconds", (ctx.guild.id, seconds))
-            await db.commit()
+    async def setcooldown(self, ctx: commands.Context, seconds: commands.Range[int, 0, MAX_COOLDOWN_SECONDS]):
+        await self.storage.update_guild_settings(ctx.guild.id, cooldown_seconds=seconds)
+        self.invalidate_guild_settings(ctx.guild.id)
         await ctx.send(f"✅ XP gain cooldown set to `{seconds}` seconds.")
 
+    @levelconfig.command(name="setvoicexp", description="Sets XP gained per minute in voice with others (0 to disable).")
+    @commands.has_permissions(manage_guild=True)
+    async def setvoicexp(self, ctx: commands.Context, amount: commands.Range[int, 0, 1000]):
+        await self.storage.update_guild_settings(ctx.guild.id, voice_xp_per_minute=amount)
+        self.invalidate_guild_settings(ctx.guild.id)
+        if amount:
+            await ctx.send(f"✅ Members now earn `{amount}` XP per minute in voice channels with at least one other listener.")
+        else:
+            await ctx.send("✅ Voice XP has been **disabled**.")
+
+    @levelconfig.command(name="setreactionxp", description="Sets XP a message author gains per reaction received (0 to disable).")
+    @commands.has_permissions(manage_guild=True)
+    async def setreactionxp(self, ctx: commands.Context, amount: commands.Range[int, 0, 1000]):
+        await self.storage.update_guild_settings(ctx.guild.id, reaction_xp=amount)
+        self.invalidate_guild_settings(ctx.guild.id)
+        if amount:
+            await ctx.send(f"✅ Message authors now earn `{amount}` XP per reaction from others (subject to the XP cooldown).")
+        else:
+            await ctx.send("✅ Reaction XP has been **disabled**.")
+
     @levelconfig.command(name="addrole", description="Assigns a role to be given when a user reaches a specific level.")
     @commands.has_permissions(manage_guild=True)
     async def setlevelrole(self, ctx: commands.Context, level: commands.Range[int, 1, 1000], role: discord.Role):
@@ -287,23 +864,24 @@ class LevelingSystem(commands.Cog):
             await ctx.send(f"❌ The role {role.mention} is a Nitro Booster role or managed by a bot and cannot be assigned.", ephemeral=True)
             return
 
-        _, _, _, level_roles_config = await self.get_guild_settings(ctx.guild.id)
-        level_roles_config[str(level)] = str(role.id)
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("INSERT INTO guild_settings (guild_id, level_roles) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET level_roles = excluded.level_roles", (ctx.guild.id, json.dumps(level_roles_config)))
-            await db.commit()
-        await ctx.send(f"✅ Users reaching Level `{level}` will now receive the {role.mention} role.")
+        await self.storage.set_level_role(ctx.guild.id, level, role.id)
+        self.invalidate_guild_settings(ctx.guild.id)
+        await self.start_role_sync(ctx.guild, restart=True)
+        await ctx.send(f"✅ Users reaching Level `{level}` will now receive the {role.mention} role. "
+                       f"Members already past it are getting it in the background (`/levelconfig syncroles status`).")
 
     @levelconfig.command(name="removerole", description="Removes a role assignment for a specific level.")
     @commands.has_permissions(manage_guild=True)
     async def removelevelrole(self, ctx: commands.Context, level: int):
-        _, _, _, level_roles_config = await self.get_guild_settings(ctx.guild.id)
-        if str(level) in level_roles_config:
-            removed_role_id = level_roles_config.pop(str(level))
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("UPDATE guild_settings SET level_roles = ? WHERE guild_id = ?", (json.dumps(level_roles_config), ctx.guild.id))
-                await db.commit()
-            role = ctx.guild.get_role(int(removed_role_id))
+        settings = await self.get_guild_settings(ctx.guild.id)
+        removed_role_id = settings.role_for_level(level)
+        if removed_role_id is not None:
+            await self.storage.remove_level_role(ctx.guild.id, level)
+            self.invalidate_guild_settings(ctx.guild.id)
+            job = self.role_syncs.get(ctx.guild.id)
+            if job is not None and job.running:
+                await self.start_role_sync(ctx.guild, restart=True)
+            role = ctx.guild.get_role(removed_role_id)
             await ctx.send(f"✅ Role assignment for Level `{level}` ({role.mention if role else 'Unknown Role'}) has been removed.")
         else:
             await ctx.send(f"❌ No role is assigned to Level `{level}`.", ephemeral=True)
@@ -311,52 +889,129 @@ class LevelingSystem(commands.Cog):
     @levelconfig.command(name="listroles", description="Lists all configured level roles.")
     @commands.has_permissions(manage_guild=True)
     async def listlevelroles(self, ctx: commands.Context):
-        _, _, _, level_roles_config = await self.get_guild_settings(ctx.guild.id)
-        if not level_roles_config:
+        settings = await self.get_guild_settings(ctx.guild.id)
+        if not settings.level_roles:
             await ctx.send("No level roles are currently configured for this server.", ephemeral=True)
             return
 
         embed = discord.Embed(title=f"🏅 Configured Level Roles for {ctx.guild.name}", color=discord.Color.purple())
         description_lines = []
-        for level_str, role_id_str in sorted(level_roles_config.items(), key=lambda item: int(item[0])):
-            role = ctx.guild.get_role(int(role_id_str))
-            description_lines.append(f"**Level `{level_str}`** → {role.mention if role else f'`Role ID: {role_id_str} (Not Found)`'}")
+        for lvl, role_id in settings.level_roles:
+            role = ctx.guild.get_role(role_id)
+            description_lines.append(f"**Level `{lvl}`** → {role.mention if role else f'`Role ID: {role_id} (Not Found)`'}")
         
         embed.description = "\n".join(description_lines)
         await ctx.send(embed=embed)
 
+    @levelconfig.command(name="syncroles", description="Gives members every level role they have already earned.")
+    @commands.has_permissions(manage_guild=True)
+    async def syncroles(self, ctx: commands.Context, action: Literal['start', 'status', 'stop'] = 'start'):
+        job = self.role_syncs.get(ctx.guild.id)
+        if action == 'status':
+            await ctx.send(job.progress_text() if job is not None else "No level role sync has run since the bot started.", ephemeral=True)
+            return
+        if action == 'stop':
+            if job is None or not job.running:
+                await ctx.send("❌ No level role sync is running.", ephemeral=True)
+                return
+            await job.stop()
+            await ctx.send(f"{job.progress_text()}\nRun `/levelconfig syncroles` to continue from here.")
+            return
+
+        settings = await self.get_guild_settings(ctx.guild.id)
+        if not settings.level_roles:
+            await ctx.send("❌ No level roles are configured for this server.", ephemeral=True)
+            return
+        resume = job is not None and not job.running and not job.done
+        job = await self.start_role_sync(ctx.guild, job.last_user_id if resume else 0, job.granted if resume else 0)
+        message = await ctx.send(f"🏅 Syncing level roles...\n{job.progress_text()}")
+        # Report progress by editing the one message until the job stops.
+        while job.running:
+            await asyncio.wait([job.task], timeout=10)
+            try:
+                await message.edit(content=f"🏅 Level role sync\n{job.progress_text()}")
+            except discord.HTTPException:
+                break
+
+    @levelconfig.command(name="importxp", description="Imports XP for this server from a CSV or JSONL dump; levels are recomputed.")
+    @commands.has_permissions(manage_guild=True)
+    async def importxp(self, ctx: commands.Context, dump: discord.Attachment, reset: bool = False):
+        await ctx.defer()
+        with tempfile.TemporaryFile() as raw:
+            await dump.save(raw)
+            with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as stream:
+                # Decode everything once up front, so a bad file fails before anything is deleted or written.
+                try:
+                    for _ in stream:
+                        pass
+                except UnicodeDecodeError:
+                    await ctx.send("❌ The dump isn't valid UTF-8 text. Export it as UTF-8 CSV or JSONL and try again.", ephemeral=True)
+                    return
+                stream.seek(0)
+                result = await self._import_guild_xp(ctx.guild.id, read_records(stream, detect_format(dump.filename)), reset)
+        logger.info(f"Imported {result.imported} XP rows into guild {ctx.guild.id} (reset={reset}, skipped={result.skipped}).")
+        await ctx.send(f"✅ Imported XP for `{result.imported:,}` users{' after resetting the server' if reset else ''}. Skipped `{result.skipped:,}` unreadable rows.")
+
+    async def _import_guild_xp(self, guild_id, records, reset):
+        # XP earned mid-import would be computed from pre-import values and written over the
+        # imported ones, so the guild's events wait. The flush leaves nothing of the guild's
+        # buffered, and every cached value is dropped before and after.
+        async with self.pause_guild(guild_id):
+            await self.flush_xp()
+            if self.user_state is not None:
+                self.user_state.mark_dirty()
+            self.invalidate_guild_xp(guild_id)
+            try:
+                if reset:
+                    await self.storage.delete_guild_users(guild_id)
+                # Smaller chunks than the CLI so the bot keeps serving other guilds between transactions.
+                return await import_xp(self.storage, records, guild_id=guild_id, chunk_size=5000)
+            finally:
+                self.invalidate_guild_xp(guild_id)
+
+    @levelconfig.command(name="exportxp", description="Exports this server's XP as a CSV file.")
+    @commands.has_permissions(manage_guild=True)
+    async def exportxp(self, ctx: commands.Context):
+        await ctx.defer()
+        await self.flush_xp()
+        with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as out:
+            exported = await export_xp(self.storage, ctx.guild.id, out)
+            size = out.tell()
+            if size > ctx.guild.filesize_limit:
+                await ctx.send(f"❌ The export ({size / 1024 / 1024:.1f} MB) is too large to upload here. Use `python -m utils.bulk_xp export` on the bot host instead.", ephemeral=True)
+                return
+            out.seek(0)
+            data = io.BytesIO(out.read().encode('utf-8'))
+        await ctx.send(f"📦 Exported `{exported:,}` users.", file=discord.File(data, filename=f"xp-{ctx.guild.id}.csv"))
+
     @levelconfig.command(name="setchannelxp", description="Sets an XP multiplier for a specific channel (e.g., 1.5 for 1.5x XP).")
     @commands.has_permissions(manage_guild=True)
     async def setchannelmultiplier(self, ctx: commands.Context, channel: discord.TextChannel, multiplier: commands.Range[float, 0.0, 10.0]):
-        _, _, _, _, channel_multipliers_config = await self.get_guild_settings(ctx.guild.id)
+        settings = await self.get_guild_settings(ctx.guild.id)
         if multiplier == 1.0:
-            if str(channel.id) in channel_multipliers_config:
-                del channel_multipliers_config[str(channel.id)]
+            if channel.id in settings.channel_multipliers:
+                await self.storage.remove_channel_multiplier(ctx.guild.id, channel.id)
                 message = f"✅ XP multiplier for {channel.mention} has been reset to default (1x)."
             else:
                 await ctx.send(f"ℹ️ XP multiplier for {channel.mention} is already at default (1x). No changes made.", ephemeral=True)
                 return
-        elif multiplier == 0.0:
-            channel_multipliers_config[str(channel.id)] = 0.0
-            message = f"✅ XP gain in {channel.mention} has been **disabled** (0x multiplier)."
         else:
-            channel_multipliers_config[str(channel.id)] = multiplier
-            message = f"✅ XP multiplier for {channel.mention} set to `{multiplier}x`."
+            await self.storage.set_channel_multiplier(ctx.guild.id, channel.id, multiplier)
+            if multiplier == 0.0:
+                message = f"✅ XP gain in {channel.mention} has been **disabled** (0x multiplier)."
+            else:
+                message = f"✅ XP multiplier for {channel.mention} set to `{multiplier}x`."
         
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("UPDATE guild_settings SET channel_multipliers = ? WHERE guild_id = ?", (json.dumps(channel_multipliers_config), ctx.guild.id))
-            await db.commit()
+        self.invalidate_guild_settings(ctx.guild.id)
         await ctx.send(message)
 
     @levelconfig.command(name="removechannelxp", description="Removes an XP multiplier from a specific channel, reverting to default.")
     @commands.has_permissions(manage_guild=True)
     async def removechannelmultiplier(self, ctx: commands.Context, channel: discord.TextChannel):
-        _, _, _, _, channel_multipliers_config = await self.get_guild_settings(ctx.guild.id)
-        if str(channel.id) in channel_multipliers_config:
-            del channel_multipliers_config[str(channel.id)]
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("UPDATE guild_settings SET channel_multipliers = ? WHERE guild_id = ?", (json.dumps(channel_multipliers_config), ctx.guild.id))
-                await db.commit()
+        settings = await self.get_guild_settings(ctx.guild.id)
+        if channel.id in settings.channel_multipliers:
+            await self.storage.remove_channel_multiplier(ctx.guild.id, channel.id)
+            self.invalidate_guild_settings(ctx.guild.id)
             await ctx.send(f"✅ XP multiplier for {channel.mention} has been removed. It will now use the server default XP rate (1x).")
         else:
             await ctx.send(f"❌ No specific XP multiplier is set for {channel.mention}. It's already using the default rate.", ephemeral=True)
@@ -364,19 +1019,19 @@ class LevelingSystem(commands.Cog):
     @levelconfig.command(name="listchannelxp", description="Lists all channel-specific XP multipliers.")
     @commands.has_permissions(manage_guild=True)
     async def listchannelmultipliers(self, ctx: commands.Context):
-        _, _, _, _, channel_multipliers_config = await self.get_guild_settings(ctx.guild.id)
-        if not channel_multipliers_config:
+        settings = await self.get_guild_settings(ctx.guild.id)
+        if not settings.channel_multipliers:
             await ctx.send("No channel-specific XP multipliers are configured for this server.", ephemeral=True)
             return
 
         embed = discord.Embed(title=f"💸 Channel XP Multipliers for {ctx.guild.name}", color=discord.Color.green())
         description_lines = []
-        for channel_id_str, multiplier in sorted(channel_multipliers_config.items(), key=lambda item: float(item[1] if isinstance(item[1], (int, float)) else 1.0), reverse=True):
-            channel_obj = ctx.guild.get_channel(int(channel_id_str))
+        for channel_id, multiplier in sorted(settings.channel_multipliers.items(), key=lambda item: item[1], reverse=True):
+            channel_obj = ctx.guild.get_channel(channel_id)
             status = f'`{multiplier}x` XP'
             if multiplier == 0.0:
                 status = '`Disabled (0x)`'
-            description_lines.append(f"{channel_obj.mention if channel_obj else f'`Channel ID: {channel_id_str} (Not Found)`'}: {status}")
+            description_lines.append(f"{channel_obj.mention if channel_obj else f'`Channel ID: {channel_id} (Not Found)`'}: {status}")
         
         embed.description = "\n".join(description_lines)
         await ctx.send(embed=embed)
@@ -386,8 +1041,8 @@ class LevelingSystem(commands.Cog):
         embed = discord.Embed(title="✨ Leveling System Help ✨", color=discord.Color.teal())
         embed.description = "Here are the available commands for the leveling system:"
 
-        embed.add_field(name="`!rank [member]`", value="Check your or another member's rank, XP, and level.", inline=False)
-        embed.add_field(name="`!leaderboard`", value="Display the server's top 10 users by XP.", inline=False)
+        embed.add_field(name="`!rank [member] [period]`", value="Check your or another member's rank, XP, and level. Set `period` to `daily`, `weekly` or `monthly` for XP earned in that window.", inline=False)
+        embed.add_field(name="`!leaderboard [page] [period]`", value="Display the server's leaderboard by XP. Use `page` to jump ahead, or the buttons to browse. `period` works as for `rank`.", inline=False)
         
         admin_header = "🛠️ Admin Configuration Commands (`/levelconfig`)"
         admin_commands_value = (
@@ -395,16 +1050,67 @@ class LevelingSystem(commands.Cog):
             "`setchannel [channel]` - Set the channel for level-up messages (leave blank to reset).\n"
             "`setxp <amount>` - Set base XP gained per message (1-1000).\n"
             "`setcooldown <seconds>` - Set XP gain cooldown (0-3600s).\n"
+            "`setvoicexp <amount>` - XP per minute in voice with others (0 = off).\n"
+            "`setreactionxp <amount>` - XP per reaction received (0 = off).\n"
             "`addrole <level> <role>` - Assign a role for reaching a level.\n"
             "`removerole <level>` - Remove role assignment for a level.\n"
             "`listroles` - List all configured level-to-role assignments.\n"
+            "`syncroles [start|status|stop]` - Grant level roles members already earned.\n"
             "`setchannelxp <channel> <multiplier>` - Set XP multiplier for a channel (e.g., 1.5 for 1.5x, 0 to disable XP).\n"
             "`removechannelxp <channel>` - Remove XP multiplier from a channel.\n"
-            "`listchannelxp` - List all channel XP multipliers."
+            "`listchannelxp` - List all channel XP multipliers.\n"
+            "`importxp <file> [reset]` - Import XP from a CSV/JSONL dump (optionally wiping current XP first).\n"
+            "`exportxp` - Download this server's XP as CSV."
         )
         embed.add_field(name=admin_header, value=admin_commands_value, inline=False)
         embed.set_footer(text=f"Use {ctx.prefix}command or /command for slash commands.")
         await ctx.send(embed=embed)
 
+class LeaderboardView(discord.ui.View):
+    def __init__(self, cog, author_id, page, page_count, period='all'):
+        super().__init__(timeout=120)
+        self.cog = cog
+        self.author_id = author_id
+        self.page = page
+        self.page_count = page_count
+        self.period = period
+        self.message = None
+        self._sync_buttons()
+
+    def _sync_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Run `/leaderboard` yourself to browse the pages.", ephemeral=True)
+            return False
+        return True
+
+    async def _show(self, interaction, page):
+        result = await self.cog.get_leaderboard_page(interaction.guild, max(page, 0), self.period)
+        if result is None:
+            self.stop()
+            await interaction.response.edit_message(content="The leaderboard is currently empty. Get chatting to rank up!", embed=None, view=None)
+            return
+        embed, self.page, self.page_count = result
+        self._sync_buttons()
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="Previous", emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
 async def setup(bot):
     await bot.add_cog(LevelingSystem(bot))
\ No newline at end of file
@@ -0,0 +1,39 @@
+import io
+import unittest
+
+from utils.bulk_xp import export_xp, import_xp, read_records, recalculate_levels
+from utils.levels import level_for_xp
+from utils.storage import open_storage
+
+
+class BulkXPTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.storage = open_storage('sqlite:///:memory:')
+        await self.storage.connect()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def test_csv_import_recomputes_levels(self):
+        dump = io.StringIO("user_id,xp,level\n10,500,99\n11,abc,1\n12,-5,0\n")
+        result = await import_xp(self.storage, read_records(dump, 'csv'), guild_id=1)
+        self.assertEqual((result.imported, result.skipped), (2, 1))
+        self.assertEqual(await self.storage.get_user(1, 10), (500, level_for_xp(500), 0))
+        self.assertEqual(await self.storage.get_user(1, 12), (0, 0, 0))
+
+    async def test_malformed_jsonl_lines_are_skipped(self):
+        dump = io.StringIO('{"user_id": 10, "xp": 500}\n{broken\n[1, 2]\n\n{"guild_id": 2, "user_id": 11, "xp": 40}\n')
+        with self.assertLogs('discord', 'WARNING'):
+            result = await import_xp(self.storage, read_records(dump, 'jsonl'), chunk_size=1)
+        self.assertEqual((result.imported, result.skipped), (1, 3))
+        self.assertEqual(await self.storage.get_user(2, 11), (40, 0, 0))
+
+    async def test_export_and_recalculate(self):
+        await self.storage.upsert_users([(1, user_id, user_id * 100, 0, 0) for user_id in range(1, 51)])
+        out = io.StringIO()
+        self.assertEqual(await export_xp(self.storage, 1, out, batch_size=7), 50)
+        self.assertEqual(len(out.getvalue().splitlines()), 51)
+        checked, changed = await recalculate_levels(self.storage, 1, batch_size=7)
+        self.assertEqual(checked, 50)
+        self.assertEqual(changed, sum(1 for user_id in range(1, 51) if level_for_xp(user_id * 100)))
+        self.assertEqual(await recalculate_levels(self.storage, 1), (50, 0))
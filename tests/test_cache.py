@@ -0,0 +1,62 @@
+import unittest
+
+from utils.cache import CooldownIndex, GuildSettings, GuildSettingsCache
+
+
+class GuildSettingsCacheTest(unittest.TestCase):
+    def test_put_get_invalidate(self):
+        cache = GuildSettingsCache(maxsize=2)
+        cache.put(1, GuildSettings(xp_per_message=20))
+        self.assertEqual(cache.get(1).xp_per_message, 20)
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = GuildSettingsCache(maxsize=2)
+        for guild_id in (1, 2):
+            cache.put(guild_id, GuildSettings())
+        cache.get(1)
+        cache.put(3, GuildSettings())
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+
+    def test_expires(self):
+        cache = GuildSettingsCache(ttl=-1)
+        cache.put(1, GuildSettings())
+        self.assertIsNone(cache.get(1))
+
+    def test_load_started_before_invalidate_is_not_cached(self):
+        cache = GuildSettingsCache()
+        generation = cache.generation(1)
+        cache.invalidate(1)
+        cache.put(1, GuildSettings(xp_per_message=15), generation)
+        self.assertIsNone(cache.get(1))
+        cache.put(1, GuildSettings(xp_per_message=100), cache.generation(1))
+        self.assertEqual(cache.get(1).xp_per_message, 100)
+
+
+class CooldownIndexTest(unittest.TestCase):
+    def test_check(self):
+        cooldowns = CooldownIndex()
+        cooldowns.record((1, 1), 1000)
+        self.assertTrue(cooldowns.check((1, 1), 1030, 60))
+        self.assertFalse(cooldowns.check((1, 1), 1060, 60))
+        self.assertFalse(cooldowns.check((1, 2), 1030, 60))
+        self.assertEqual((cooldowns.checks, cooldowns.rejected), (3, 1))
+
+    def test_older_timestamp_is_ignored(self):
+        cooldowns = CooldownIndex()
+        cooldowns.record((1, 1), 1000)
+        cooldowns.record((1, 1), 900)
+        self.assertTrue(cooldowns.check((1, 1), 1030, 60))
+
+    def test_prunes_entries_past_the_horizon(self):
+        cooldowns = CooldownIndex(horizon=3600, bucket_seconds=60)
+        for user_id in range(100):
+            cooldowns.record((1, user_id), 1000)
+        cooldowns.record((1, 1000), 1000 + 1800)
+        self.assertEqual(len(cooldowns), 101)
+        cooldowns.record((1, 1001), 1000 + 3600 + 120)
+        self.assertEqual(len(cooldowns), 2)
+        self.assertFalse(cooldowns.check((1, 5), 1000 + 3600 + 120, 3600))
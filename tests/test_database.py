@@ -0,0 +1,22 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from utils.database import Database
+
+
+class ReadPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def test_connects_with_readers(self):
+        # Unread PRAGMA results used to keep the writer locked, so readers couldn't open.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'pool.db')
+            for run in range(2):
+                db = Database(path, read_pool_size=2)
+                try:
+                    await asyncio.wait_for(db.connect(), 30)
+                    await db.execute("CREATE TABLE IF NOT EXISTS t (x INTEGER)")
+                    await db.execute("INSERT INTO t VALUES (5)")
+                    self.assertEqual(await db.fetchone("SELECT COUNT(*) FROM t"), (run + 1,))
+                finally:
+                    await db.close()
@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from utils.dispatcher import SideEffectDispatcher
+from utils.metrics import Metrics
+
+
+class SideEffectDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dispatcher = SideEffectDispatcher(Metrics(), window=0)
+        self.sent = []
+
+    async def asyncTearDown(self):
+        await self.dispatcher.stop()
+
+    def channel(self, channel_id, on_send=None):
+        async def send(content):
+            self.sent.append((channel_id, content))
+            if on_send is not None:
+                on_send()
+        return SimpleNamespace(id=channel_id, send=send)
+
+    async def test_coalesces_announcements(self):
+        channel = self.channel(1)
+        for level in (2, 3):
+            self.dispatcher.announce(channel, f"level {level}")
+        await self.dispatcher.stop()
+        self.assertEqual(self.sent, [(1, "level 2\nlevel 3")])
+        self.assertEqual(self.dispatcher.pending, 0)
+
+    async def test_announcement_queued_as_the_worker_exits_is_sent(self):
+        def announce_again():
+            self.dispatcher.announce(channel, "level 3")
+
+        def on_send():
+            # Runs after the worker's last send but before its done callback.
+            if len(self.sent) == 1:
+                asyncio.get_running_loop().call_soon(announce_again)
+        channel = self.channel(1, on_send)
+        self.dispatcher.announce(channel, "level 2")
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await self.dispatcher.stop()
+        self.assertEqual(self.sent, [(1, "level 2"), (1, "level 3")])
@@ -0,0 +1,219 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from cogs.leveling import LevelingSystem
+from utils.ranking import LEADERBOARD_PAGE_SIZE
+from utils.xp_events import MESSAGE, REACTION, XPEvent
+
+GUILD_ID = 1
+
+
+class StubContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.author = SimpleNamespace(id=1)
+        self.sent = []
+
+    async def defer(self):
+        pass
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class StubAttachment:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+
+    async def save(self, fp):
+        fp.write(self.data)
+        fp.seek(0)
+
+
+class LevelingTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.guild = SimpleNamespace(id=GUILD_ID, name="guild")
+        self.bot = SimpleNamespace(database_url='sqlite:///:memory:', guilds=[], get_channel=lambda channel_id: None,
+                                   wait_until_ready=self._ready)
+        self.cog = LevelingSystem(self.bot)
+        await self.cog.cog_load()
+        await self.cog.ready.wait()
+
+    async def asyncTearDown(self):
+        await self.cog.cog_unload()
+
+    async def _ready(self):
+        pass
+
+    def event(self, source, user_id, timestamp, guild_id=GUILD_ID):
+        return XPEvent(source, guild_id, user_id, 100, timestamp)
+
+    async def xp(self, user_id, guild_id=GUILD_ID):
+        return (await self.cog.get_user_data(user_id, guild_id) or (0,))[0]
+
+    def gate(self, name):
+        """Make a storage call block until the returned `release` event is set; `started` is set once it's entered."""
+        started, release = asyncio.Event(), asyncio.Event()
+        call = getattr(self.cog.storage, name)
+
+        async def gated(*args, **kwargs):
+            started.set()
+            await release.wait()
+            return await call(*args, **kwargs)
+        setattr(self.cog.storage, name, gated)
+        return started, release
+
+
+class GuildSettingsTest(LevelingTestCase):
+    async def test_change_during_a_load_is_not_overwritten(self):
+        started, release = self.gate('get_guild_settings')
+        load = asyncio.create_task(self.cog.get_guild_settings(GUILD_ID))
+        await started.wait()
+        await self.cog.storage.update_guild_settings(GUILD_ID, xp_per_message=100)
+        self.cog.invalidate_guild_settings(GUILD_ID)
+        release.set()
+        await load
+        self.assertEqual((await self.cog.get_guild_settings(GUILD_ID)).xp_per_message, 100)
+
+
+class XPEventTest(LevelingTestCase):
+    async def test_message_cooldown(self):
+        await self.cog.apply_xp_events([self.event(MESSAGE, 10, 1000), self.event(MESSAGE, 10, 1010)])
+        await self.cog.apply_xp_events([self.event(MESSAGE, 10, 1030), self.event(MESSAGE, 10, 1070)])
+        self.assertEqual(await self.xp(10), 30)
+        # The second batch's first message is turned away by the cooldown index, before any user rows are read.
+        self.assertEqual(self.cog.metrics.counters.get('cooldown_rejects_early'), 1)
+        gauges = self.cog.collect_gauges()
+        self.assertEqual((gauges['cooldown_index_checks'], gauges['cooldown_index_rejected']), (4, 1))
+
+    async def test_reaction_cooldown_within_one_batch(self):
+        await self.cog.storage.update_guild_settings(GUILD_ID, reaction_xp=10)
+        await self.cog.apply_xp_events([self.event(REACTION, 10, 1000 + i) for i in range(5)])
+        self.assertEqual(await self.xp(10), 10)
+        # Reactions don't put chat on cooldown.
+        await self.cog.apply_xp_events([self.event(MESSAGE, 10, 1005)])
+        self.assertEqual(await self.xp(10), 25)
+
+    async def test_warming_guild_does_not_hold_up_others(self):
+        started, release = self.gate('recent_users')
+        self.bot.guilds = [self.guild]
+        warm_up = asyncio.create_task(self.cog.warm_up())
+        await started.wait()
+        await asyncio.wait_for(self.cog.apply_xp_events([self.event(MESSAGE, 10, 1000), self.event(MESSAGE, 10, 1000, guild_id=2)]), 5)
+        self.assertEqual((await self.xp(10), await self.xp(10, guild_id=2)), (0, 15))
+        release.set()
+        await warm_up
+        await self.cog.xp_events.join()
+        self.assertEqual(await self.xp(10), 15)
+
+
+class LeaderboardTest(LevelingTestCase):
+    async def test_pages_past_the_cached_top_k(self):
+        users = self.cog.leaderboard_size * 5
+        await self.cog.storage.upsert_users([(GUILD_ID, user_id, 100_000 - user_id, 1, 0) for user_id in range(1, users + 1)])
+        last_page = users // LEADERBOARD_PAGE_SIZE - 1
+        embed, page, page_count = await self.cog.get_leaderboard_page(self.guild, last_page)
+        self.assertEqual((page, page_count), (last_page, users // LEADERBOARD_PAGE_SIZE))
+        self.assertTrue(embed.description.startswith(f"`#{users - LEADERBOARD_PAGE_SIZE + 1}` <@{users - LEADERBOARD_PAGE_SIZE + 1}>"))
+        # Pages inside the cached top-K carry the real page count too.
+        embed, page, page_count = await self.cog.get_leaderboard_page(self.guild, 0)
+        self.assertEqual((page, page_count), (0, users // LEADERBOARD_PAGE_SIZE))
+        self.assertTrue(embed.description.startswith("`#1` <@1>"))
+
+    async def test_large_guild_reuses_cached_pages(self):
+        users = self.cog.leaderboard_size * 5
+        await self.cog.storage.upsert_users([(GUILD_ID, user_id, 100_000 - user_id, 1, 0) for user_id in range(1, users + 1)])
+        embed = (await self.cog.get_leaderboard_page(self.guild, 0))[0]
+
+        async def count_ranked(guild_id):
+            raise AssertionError("the page count should come from the rank index")
+        self.cog.storage.count_ranked = count_ranked
+        self.assertIs((await self.cog.get_leaderboard_page(self.guild, 0))[0], embed)
+        # A newcomer below the top-K adds a page, so the cached page is rendered again.
+        await self.cog.update_user_data(users + 1, GUILD_ID, 1, 0, 0)
+        embed, page, page_count = await self.cog.get_leaderboard_page(self.guild, 0)
+        self.assertEqual(page_count, users // LEADERBOARD_PAGE_SIZE + 1)
+        self.assertIn(f"Page 1/{page_count}", embed.footer.text)
+
+    async def test_small_guild_uses_cached_pages(self):
+        await self.cog.storage.upsert_users([(GUILD_ID, user_id, 1000 - user_id, 1, 0) for user_id in range(1, 16)])
+        embed, page, page_count = await self.cog.get_leaderboard_page(self.guild, 5)
+        self.assertEqual((page, page_count), (1, 2))
+        self.assertIs((await self.cog.get_leaderboard_page(self.guild, 1))[0], embed)
+
+
+class ImportXPTest(LevelingTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.ctx = StubContext(self.guild)
+
+    def run_import(self, data, reset=False):
+        dump = StubAttachment('dump.csv', data)
+        return asyncio.create_task(self.cog.importxp.callback(self.cog, self.ctx, dump, reset))
+
+    async def test_xp_earned_during_a_reset_import_starts_from_zero(self):
+        await self.cog.apply_xp_events([self.event(MESSAGE, 10, 1000)])
+        await self.cog.update_user_data(10, GUILD_ID, 500, 3, 1000)
+
+        # Hold the import right after it starts, and chat in the meantime.
+        started, release = self.gate('delete_guild_users')
+        import_task = self.run_import("\ufeffuser_id,xp\n20,300\n".encode('utf-8'), reset=True)
+        await started.wait()
+        self.cog.xp_events.put(self.event(MESSAGE, 10, 2000))
+        await self.cog.xp_events.join()
+        release.set()
+        await import_task
+        await self.cog.xp_events.join()
+        await self.cog.flush_xp()
+
+        self.assertEqual(await self.xp(10), 15)
+        self.assertEqual((await self.cog.storage.get_user(GUILD_ID, 10))[0], 15)
+        self.assertEqual((await self.cog.storage.get_user(GUILD_ID, 20))[0], 300)
+
+    async def test_other_guilds_are_served_during_an_import(self):
+        started, release = self.gate('delete_guild_users')
+        import_task = self.run_import(b"user_id,xp\n20,300\n", reset=True)
+        await started.wait()
+        self.cog.xp_events.put(self.event(MESSAGE, 10, 1000, guild_id=2))
+        await asyncio.wait_for(self.cog.xp_events.join(), 5)
+        self.assertEqual(await self.xp(10, guild_id=2), 15)
+        self.assertFalse(import_task.done())
+        release.set()
+        await import_task
+
+    async def test_undecodable_dump_changes_nothing(self):
+        await self.cog.update_user_data(10, GUILD_ID, 500, 3, 1000)
+        await self.run_import(b"user_id,xp\n20,300\n\xff\xfe\n", reset=True)
+        self.assertIn("UTF-8", self.ctx.sent[-1])
+        self.assertEqual(await self.xp(10), 500)
+        self.assertIsNone(await self.cog.storage.get_user(GUILD_ID, 20))
+
+
+class VoiceSweepTest(LevelingTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        listening = SimpleNamespace(deaf=False, self_deaf=False)
+        members = [SimpleNamespace(id=user_id, bot=False, voice=listening) for user_id in (10, 11)]
+        self.guild.afk_channel = None
+        self.guild.voice_channels = [SimpleNamespace(id=200, members=members)]
+        self.bot.guilds = [self.guild]
+
+    async def test_skips_guilds_without_voice_xp(self):
+        await self.cog.sweep_voice(1)
+        self.assertNotIn('xp_events_voice', self.cog.metrics.counters)
+
+    async def test_awards_voice_xp(self):
+        await self.cog.storage.update_guild_settings(GUILD_ID, voice_xp_per_minute=10)
+        await self.cog.sweep_voice(2)
+        await self.cog.xp_events.join()
+        self.assertEqual((await self.xp(10), await self.xp(11)), (20, 20))
+
+    async def test_leaves_room_for_messages(self):
+        await self.cog.storage.update_guild_settings(GUILD_ID, voice_xp_per_minute=10)
+        self.cog.voice_max_pending = 1
+        await self.cog.get_guild_settings(GUILD_ID)
+        await self.cog.sweep_voice(1)
+        self.assertTrue(self.cog.xp_events.put(self.event(MESSAGE, 12, 1000)))
+        self.assertEqual((self.cog.metrics.counters['xp_events_voice'], self.cog.metrics.counters['xp_events_dropped']), (1, 1))
@@ -0,0 +1,60 @@
+import json
+import unittest
+
+from utils.migrations import SCHEMA_VERSION, migrate
+from utils.storage import SQLiteStorage
+
+
+class MigrationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.storage = SQLiteStorage(':memory:')
+        await self.storage.db.connect()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def seed_legacy(self, rows):
+        # The schema the bot used before migrations existed, with settings as JSON blobs.
+        await self.storage.db.execute('''
+            CREATE TABLE guild_settings (
+                guild_id INTEGER PRIMARY KEY,
+                level_up_channel_id INTEGER,
+                xp_per_message INTEGER DEFAULT 15,
+                cooldown_seconds INTEGER DEFAULT 60,
+                level_roles TEXT DEFAULT '{}',
+                channel_multipliers TEXT DEFAULT '{}'
+            )
+        ''')
+        await self.storage.db.executemany("INSERT INTO guild_settings VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    async def test_fresh_database_reaches_current_version(self):
+        self.assertEqual(await migrate(self.storage.db), 0)
+        self.assertEqual((await self.storage.db.fetchone("PRAGMA user_version"))[0], SCHEMA_VERSION)
+        self.assertEqual(await migrate(self.storage.db), SCHEMA_VERSION)
+
+    async def test_json_settings_move_to_tables(self):
+        await self.seed_legacy([
+            (1, 555, 20, 30, json.dumps({"5": 105, "10": 110}), json.dumps({"77": 1.5})),
+            (2, None, None, None, None, None),
+        ])
+        await migrate(self.storage.db)
+        settings = await self.storage.get_guild_settings(1)
+        self.assertEqual((settings.level_up_channel_id, settings.xp_per_message, settings.cooldown_seconds), (555, 20, 30))
+        self.assertEqual(list(settings.level_roles), [(5, 105), (10, 110)])
+        self.assertEqual(settings.channel_multipliers, {77: 1.5})
+        settings = await self.storage.get_guild_settings(2)
+        self.assertEqual((settings.xp_per_message, settings.cooldown_seconds), (15, 60))
+
+    async def test_unreadable_entries_only_drop_themselves(self):
+        await self.seed_legacy([
+            (1, None, 15, 60, 'not json', json.dumps({"77": 2.0, "x": 3})),
+            (2, None, 15, 60, json.dumps({"5": 105, "7": "abc"}), '[1]'),
+        ])
+        with self.assertLogs('discord', 'WARNING'):
+            await migrate(self.storage.db)
+        settings = await self.storage.get_guild_settings(1)
+        self.assertEqual((list(settings.level_roles), settings.channel_multipliers), ([], {77: 2.0}))
+        settings = await self.storage.get_guild_settings(2)
+        self.assertEqual((list(settings.level_roles), settings.channel_multipliers), ([(5, 105)], {}))
+        # The original blobs are kept for recovery.
+        self.assertEqual(await self.storage.db.fetchone("SELECT level_roles FROM guild_settings_v1 WHERE guild_id = 1"), ('not json',))
@@ -0,0 +1,58 @@
+import unittest
+
+from utils.ranking import GuildIndex, GuildLeaderboard, GuildRanking
+
+
+def leaderboard(users, size=100):
+    # users 1..users with XP 1000, 990, ...
+    return GuildLeaderboard([(user_id, 1010 - user_id * 10, 1) for user_id in range(1, users + 1)], size)
+
+
+class GuildLeaderboardTest(unittest.TestCase):
+    def test_pages(self):
+        board = leaderboard(25)
+        self.assertTrue(board.complete)
+        self.assertEqual(board.page_count, 3)
+        self.assertEqual(board.page(2), [(21, 21, 800, 1), (22, 22, 790, 1), (23, 23, 780, 1), (24, 24, 770, 1), (25, 25, 760, 1)])
+
+    def test_move_only_invalidates_pages_it_crosses(self):
+        board = leaderboard(30)
+        board.pages.update({0: 'p0', 1: 'p1', 2: 'p2'})
+        board.update(25, 905)  # from #25 to #11
+        self.assertEqual(board.pages, {0: 'p0'})
+        self.assertEqual(board.page(1)[0][1], 25)
+
+    def test_page_count_change_invalidates_everything(self):
+        board = leaderboard(30)
+        board.pages.update({0: 'p0', 1: 'p1', 2: 'p2'})
+        board.update(99, 5)
+        self.assertEqual(board.page_count, 4)
+        self.assertEqual(board.pages, {})
+
+    def test_unchanged_entry_keeps_pages(self):
+        board = leaderboard(30)
+        board.pages.update({0: 'p0'})
+        board.update(1, 1000, 1)
+        self.assertEqual(board.pages, {0: 'p0'})
+
+    def test_full_board_drops_the_last_entry(self):
+        board = leaderboard(10, size=10)
+        self.assertFalse(board.complete)
+        board.update(99, 2000)
+        self.assertEqual(len(board), 10)
+        self.assertEqual(board.page(0)[0][1], 99)
+        self.assertNotIn(10, [entry[1] for entry in board.page(0)])
+
+    def test_drop_below_unloaded_users_marks_stale(self):
+        index = GuildIndex()
+        index.put(1, leaderboard(10, size=10))
+        index.update(1, 3, 1, 1)
+        self.assertIsNone(index.get(1))
+
+
+class GuildRankingTest(unittest.TestCase):
+    def test_rank(self):
+        ranking = GuildRanking([(1, 50), (2, 300), (3, 120), (4, 0)])
+        self.assertEqual((ranking.rank(120), ranking.total), (2, 3))
+        ranking.update(1, 400)
+        self.assertEqual(ranking.rank(400), 1)
@@ -0,0 +1,89 @@
+import unittest
+
+from utils.storage import open_storage
+
+
+class SQLiteStorageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.storage = open_storage('sqlite:///:memory:')
+        await self.storage.connect()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def query_plans(self, run):
+        # Query plans of the statements `run` sends to the database.
+        statements = []
+        writer = self.storage.db._writer
+        await writer.set_trace_callback(statements.append)
+        try:
+            await run()
+        finally:
+            await writer.set_trace_callback(None)
+        plans = []
+        for sql in statements:
+            if sql.lstrip().upper().startswith(('SELECT', 'DELETE')):
+                plans.extend(row[-1] for row in await self.storage.db.fetchall(f"EXPLAIN QUERY PLAN {sql}"))
+        self.assertTrue(plans)
+        return " ".join(plans)
+
+    async def test_user_round_trip(self):
+        self.assertIsNone(await self.storage.get_user(1, 10))
+        await self.storage.upsert_user(1, 10, 120, 1, 50)
+        await self.storage.upsert_users([(1, 10, 300, 2, 60), (1, 11, 40, 0, 70), (2, 10, 5, 0, 80)])
+        self.assertEqual(await self.storage.get_user(1, 10), (300, 2, 60))
+        self.assertEqual(await self.storage.get_users(1, [10, 11, 12]), {10: (300, 2, 60), 11: (40, 0, 70)})
+
+    async def test_rank_and_top_users(self):
+        await self.storage.upsert_users([(1, user_id, xp, 0, 0) for user_id, xp in ((1, 50), (2, 300), (3, 120), (4, 0))])
+        self.assertEqual(await self.storage.rank(1, 120), (2, 3))
+        self.assertEqual(await self.storage.count_ranked(1), 3)
+        self.assertEqual([row[0] for row in await self.storage.top_users(1, 2)], [2, 3])
+        self.assertEqual([row[0] for row in await self.storage.top_users(1, 2, 2)], [1])
+
+    async def test_guild_settings(self):
+        settings = await self.storage.get_guild_settings(1)
+        self.assertEqual(settings.xp_per_message, 15)
+        await self.storage.update_guild_settings(1, xp_per_message=25, reaction_xp=3)
+        await self.storage.set_level_role(1, 10, 1010)
+        await self.storage.set_level_role(1, 5, 1005)
+        await self.storage.set_channel_multiplier(1, 77, 1.5)
+        settings = await self.storage.get_guild_settings(1)
+        self.assertEqual((settings.xp_per_message, settings.reaction_xp), (25, 3))
+        self.assertEqual(list(settings.level_roles), [(5, 1005), (10, 1010)])
+        self.assertEqual(settings.channel_multipliers, {77: 1.5})
+
+    async def test_iter_guild_users_streams_without_sorting(self):
+        await self.storage.upsert_users([(1, user_id, user_id, 0, 0) for user_id in range(1, 2501)])
+        seen = []
+
+        async def run():
+            async for rows in self.storage.iter_guild_users(1, 1000):
+                self.assertLessEqual(len(rows), 1000)
+                seen.extend(row[0] for row in rows)
+        plan = await self.query_plans(run)
+        self.assertEqual(sorted(seen), list(range(1, 2501)))
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    async def test_recent_users_uses_activity_index(self):
+        await self.storage.upsert_users([(1, 1, 10, 0, 100), (1, 2, 10, 0, 500)])
+
+        async def run():
+            self.assertEqual(await self.storage.recent_users(1, 200), [(2, 500)])
+        self.assertIn("idx_users_guild_activity", await self.query_plans(run))
+
+    async def test_period_totals(self):
+        await self.storage.upsert_users([], [(1, 0, 7, 10, 5), (1, 0, 7, 11, 9), (1, 0, 6, 10, 100), (2, 0, 7, 10, 1)])
+        await self.storage.upsert_users([], [(1, 0, 7, 10, 5)])
+        self.assertEqual(await self.storage.period_top(1, 0, 7, 10), [(10, 10), (11, 9)])
+        self.assertEqual(await self.storage.period_count(1, 0, 7), 2)
+        self.assertEqual(await self.storage.period_rank(1, 0, 7, 11), (9, 2, 2))
+        self.assertIsNone(await self.storage.period_rank(1, 0, 7, 12))
+        await self.storage.prune_period_xp(0, 7)
+        self.assertEqual(await self.storage.period_count(1, 0, 6), 0)
+        self.assertEqual(await self.storage.period_count(1, 0, 7), 2)
+
+    async def test_period_prune_uses_index(self):
+        plan = await self.query_plans(lambda: self.storage.prune_period_xp(0, 7))
+        self.assertIn("idx_xp_periods_bucket", plan)
+        self.assertNotIn("SCAN", plan)
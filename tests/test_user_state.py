@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from utils.user_state import GuildUserState, UserStateStore
+
+
+class GuildUserStateTest(unittest.TestCase):
+    def test_put_get_and_compact(self):
+        state = GuildUserState()
+        for user_id in range(1000, 0, -1):
+            state.put(user_id, user_id * 2, 1, user_id * 3)
+        self.assertEqual(len(state), 1000)
+        self.assertEqual(state.get(500), (1000, 1, 1500))
+        state.compact()
+        self.assertEqual(list(state.ids), list(range(1, 1001)))
+        self.assertFalse(state.put(500, 7, 2, 9))
+        self.assertEqual(state.get(500), (7, 2, 9))
+        self.assertIsNone(state.get(5000))
+
+
+class UserStateStoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'state.snap')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_evicts_least_recently_used_guild(self):
+        store = UserStateStore(max_guilds=2)
+        store.put(1, 10, 5, 0, 0)
+        store.put(2, 10, 5, 0, 0)
+        store.get(1, 10)
+        store.put(3, 10, 5, 0, 0)
+        self.assertEqual((store.guilds, len(store)), (2, 2))
+        self.assertIsNone(store.get(2, 10))
+        self.assertEqual(store.get(1, 10), (5, 0, 0))
+
+    async def test_snapshot_round_trip(self):
+        store = UserStateStore(snapshot_path=self.path)
+        for user_id in range(1, 301):
+            store.put(1, user_id, user_id * 10, 2, 1000 + user_id)
+        store.put(2, 42, 99, 1, 7)
+        await store.save_snapshot()
+
+        loaded = UserStateStore(snapshot_path=self.path)
+        self.assertEqual(loaded.load_snapshot(), 301)
+        self.assertEqual(loaded.get(1, 150), (1500, 2, 1150))
+        self.assertEqual(loaded.get(2, 42), (99, 1, 7))
+
+    async def test_writes_after_snapshot_invalidate_it(self):
+        store = UserStateStore(snapshot_path=self.path)
+        store.put(1, 10, 5, 0, 0)
+        await store.save_snapshot()
+        store.mark_dirty()
+        self.assertEqual(UserStateStore(snapshot_path=self.path).load_snapshot(), 0)
+
+        # Taking a new snapshot makes it trusted again.
+        await store.save_snapshot()
+        self.assertEqual(UserStateStore(snapshot_path=self.path).load_snapshot(), 1)
@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+
+from utils.storage import open_storage
+from utils.write_buffer import XPWriteBuffer
+
+
+class GatedStorage:
+    """Wraps a storage so a test can hold upsert_users mid-transaction or make it fail."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.gate = None
+        self.fail = False
+
+    async def upsert_users(self, rows, period_rows=()):
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("database unavailable")
+        await self.storage.upsert_users(rows, period_rows)
+
+
+class XPWriteBufferTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.storage = open_storage('sqlite:///:memory:')
+        await self.storage.connect()
+        self.gated = GatedStorage(self.storage)
+        self.buffer = XPWriteBuffer(self.gated, flush_interval=60, max_pending=100)
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def test_flush_writes_latest_row_per_user(self):
+        self.buffer.put(1, 10, 20, 0, 100)
+        self.buffer.put(1, 10, 35, 0, 200)
+        self.buffer.put(1, 11, 15, 0, 150)
+        self.assertEqual(self.buffer.get(1, 10), (35, 0, 200))
+        self.assertEqual(await self.buffer.flush(), 2)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertIsNone(self.buffer.get(1, 10))
+        self.assertEqual(await self.storage.get_user(1, 10), (35, 0, 200))
+        self.assertEqual(await self.buffer.flush(), 0)
+
+    async def test_failed_flush_keeps_rows_and_newer_writes(self):
+        self.buffer.put(1, 10, 20, 0, 100)
+        self.buffer.put(1, 11, 15, 0, 150)
+        self.buffer.add_period_xp(1, 0, 7, 10, 20)
+        self.gated.gate = asyncio.Event()
+        self.gated.fail = True
+        flush = asyncio.create_task(self.buffer.flush())
+        await asyncio.sleep(0)
+        # Written while the failing flush is in flight; must not be rolled back by it.
+        self.buffer.put(1, 10, 40, 0, 300)
+        self.buffer.add_period_xp(1, 0, 7, 10, 5)
+        self.gated.gate.set()
+        with self.assertRaises(RuntimeError):
+            await flush
+        self.assertEqual(self.buffer.get(1, 10), (40, 0, 300))
+        self.assertEqual(self.buffer.get(1, 11), (15, 0, 150))
+
+        self.gated.fail = False
+        self.assertEqual(await self.buffer.flush(), 2)
+        self.assertEqual(await self.storage.get_user(1, 10), (40, 0, 300))
+        self.assertEqual(await self.storage.period_top(1, 0, 7, 10), [(10, 25)])
+
+    async def test_rows_in_flight_stay_readable(self):
+        # A reader between the swap and the commit used to fall through to the old database row.
+        await self.storage.upsert_user(1, 10, 100, 0, 0)
+        self.buffer.put(1, 10, 200, 1, 50)
+        self.gated.gate = asyncio.Event()
+        flush = asyncio.create_task(self.buffer.flush())
+        await asyncio.sleep(0)
+        self.assertEqual(self.buffer.get(1, 10), (200, 1, 50))
+        self.gated.gate.set()
+        await flush
+        self.assertIsNone(self.buffer.get(1, 10))
+        self.assertEqual(await self.storage.get_user(1, 10), (200, 1, 50))
+
+    async def test_stop_flushes(self):
+        self.buffer.start()
+        self.buffer.put(1, 10, 20, 0, 100)
+        await self.buffer.stop()
+        self.assertEqual(await self.storage.get_user(1, 10), (20, 0, 100))
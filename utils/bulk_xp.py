@@ -0,0 +1,189 @@
+"""Bulk XP import, export and level recalculation.
+
+Everything streams: input is parsed one record at a time and written in
+chunked transactions, and exports read through a cursor in batches, so
+memory use doesn't grow with the number of rows.
+
+    python -m utils.bulk_xp import dump.csv --guild 1234 [--reset]
+    python -m utils.bulk_xp export out.jsonl --guild 1234
+    python -m utils.bulk_xp recalc --guild 1234
+
+Dumps are CSV with a header row or JSON Lines. Each record needs `user_id`
+and `xp`. `guild_id` is needed unless --guild is given, and
+`last_message_timestamp` is optional. A `level` column is ignored and
+recomputed from XP.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+from utils.levels import level_for_xp
+from utils.storage import open_storage
+from utils.user_state import invalidate_snapshot
+
+logger = logging.getLogger('discord')
+
+EXPORT_COLUMNS = ('guild_id', 'user_id', 'xp', 'level', 'last_message_timestamp')
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.guild_ids = set()
+
+
+def detect_format(name):
+    return 'jsonl' if name.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_records(stream, fmt):
+    # JSONL lines are yielded unparsed; import_xp parses them so a bad line is skipped, not fatal.
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def to_row(record, guild_id=None):
+    xp = max(0, int(record['xp']))
+    return (
+        int(guild_id if guild_id is not None else record['guild_id']),
+        int(record['user_id']),
+        xp,
+        level_for_xp(xp),
+        int(record.get('last_message_timestamp') or 0),
+    )
+
+
+async def import_xp(storage, records, guild_id=None, chunk_size=50000, progress=None):
+    """Upsert records in chunk_size transactions. If guild_id is given, every row goes to that guild."""
+    result = ImportResult()
+    chunk = []
+    for record in records:
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            row = to_row(record, guild_id)
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            result.skipped += 1
+            if result.skipped <= 10:
+                logger.warning(f"Skipping unreadable XP record {record!r}: {e}")
+            continue
+        chunk.append(row)
+        result.guild_ids.add(row[0])
+        if len(chunk) >= chunk_size:
+            await storage.upsert_users(chunk)
+            result.imported += len(chunk)
+            chunk = []
+            if progress is not None:
+                await progress(result.imported)
+    if chunk:
+        await storage.upsert_users(chunk)
+        result.imported += len(chunk)
+        if progress is not None:
+            await progress(result.imported)
+    return result
+
+
+async def export_xp(storage, guild_id, out, fmt='csv', batch_size=5000, progress=None):
+    writer = csv.writer(out) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(EXPORT_COLUMNS)
+    exported = 0
+    async for rows in storage.iter_guild_users(guild_id, batch_size):
+        for user_id, xp, level, ts in rows:
+            if writer is not None:
+                writer.writerow((guild_id, user_id, xp, level, ts))
+            else:
+                out.write(json.dumps(dict(zip(EXPORT_COLUMNS, (guild_id, user_id, xp, level, ts)))) + "\n")
+        exported += len(rows)
+        if progress is not None:
+            await progress(exported)
+    return exported
+
+
+async def recalculate_levels(storage, guild_id, batch_size=5000, progress=None):
+    """Rewrite every stored level that disagrees with the XP curve; returns (checked, changed)."""
+    checked = changed = 0
+    async for rows in storage.iter_guild_users(guild_id, batch_size):
+        fixed = [(guild_id, user_id, xp, level_for_xp(xp), ts) for user_id, xp, level, ts in rows if level != level_for_xp(xp)]
+        if fixed:
+            await storage.upsert_users(fixed)
+        checked += len(rows)
+        changed += len(fixed)
+        if progress is not None:
+            await progress(checked)
+    return checked, changed
+
+
+def _progress_printer(verb):
+    started = time.perf_counter()
+
+    async def progress(count):
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0.0
+        print(f"\r{verb} {count:,} rows ({rate:,.0f}/s)", end='', file=sys.stderr, flush=True)
+    return progress
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk XP import, export and level recalculation.")
+    parser.add_argument('--database-url', default=os.getenv('LEVELING_DATABASE_URL', 'sqlite:///leveling.db'))
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_import = sub.add_parser('import', help="stream a CSV/JSONL dump into the users table")
+    p_import.add_argument('path', help="dump file, or - for stdin")
+    p_import.add_argument('--guild', type=int, help="import every row into this guild")
+    p_import.add_argument('--reset', action='store_true', help="delete the guild's existing XP first (season reset)")
+    p_import.add_argument('--format', choices=('csv', 'jsonl'))
+    p_import.add_argument('--chunk-size', type=int, default=50000)
+    p_export = sub.add_parser('export', help="stream a guild's rows to CSV/JSONL")
+    p_export.add_argument('path', help="output file, or - for stdout")
+    p_export.add_argument('--guild', type=int, required=True)
+    p_export.add_argument('--format', choices=('csv', 'jsonl'))
+    p_recalc = sub.add_parser('recalc', help="recompute stored levels from XP")
+    p_recalc.add_argument('--guild', type=int, required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'import' and args.reset and args.guild is None:
+        parser.error("--reset needs --guild")
+
+    # A running bot's user state snapshot won't include what this writes.
+    if args.command in ('import', 'recalc') and os.getenv('LEVELING_STATE_SNAPSHOT'):
+        invalidate_snapshot(os.getenv('LEVELING_STATE_SNAPSHOT'))
+
+    storage = open_storage(args.database_url)
+    await storage.connect()
+    try:
+        if args.command == 'import':
+            fmt = args.format or detect_format(args.path)
+            if args.reset:
+                await storage.delete_guild_users(args.guild)
+            stream = nullcontext(sys.stdin) if args.path == '-' else open(args.path, newline='', encoding='utf-8')
+            with stream as f:
+                result = await import_xp(storage, read_records(f, fmt), args.guild, args.chunk_size, _progress_printer("Imported"))
+            print(f"\nImported {result.imported:,} rows into {len(result.guild_ids)} guild(s); skipped {result.skipped:,}.", file=sys.stderr)
+        elif args.command == 'export':
+            fmt = args.format or detect_format(args.path)
+            out = nullcontext(sys.stdout) if args.path == '-' else open(args.path, 'w', newline='', encoding='utf-8')
+            with out as f:
+                exported = await export_xp(storage, args.guild, f, fmt, progress=_progress_printer("Exported"))
+            print(f"\nExported {exported:,} rows.", file=sys.stderr)
+        else:
+            checked, changed = await recalculate_levels(storage, args.guild, progress=_progress_printer("Checked"))
+            print(f"\nChecked {checked:,} rows; corrected {changed:,} level(s).", file=sys.stderr)
+    finally:
+        await storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
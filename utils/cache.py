@@ -0,0 +1,127 @@
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class GuildSettings:
+    level_up_channel_id: Optional[int] = None
+    xp_per_message: int = 15
+    cooldown_seconds: int = 60
+    # (level, role_id) pairs sorted by level
+    level_roles: List[Tuple[int, int]] = field(default_factory=list)
+    channel_multipliers: Dict[int, float] = field(default_factory=dict)
+    # 0 turns the source off.
+    voice_xp_per_minute: int = 0
+    reaction_xp: int = 0
+
+    @classmethod
+    def from_rows(cls, row, role_rows=(), multiplier_rows=()):
+        level_up_channel_id, xp_per_message, cooldown_seconds, voice_xp_per_minute, reaction_xp = row
+        roles = sorted((level, role_id) for level, role_id in role_rows)
+        multipliers = {channel_id: multiplier for channel_id, multiplier in multiplier_rows}
+        return cls(level_up_channel_id, xp_per_message, cooldown_seconds, roles, multipliers, voice_xp_per_minute, reaction_xp)
+
+    def role_for_level(self, level):
+        i = bisect_right(self.level_roles, (level, float('inf')))
+        if i and self.level_roles[i - 1][0] == level:
+            return self.level_roles[i - 1][1]
+        return None
+
+    def roles_between(self, low, high):
+        """Role ids for levels above `low` up to and including `high`."""
+        start = bisect_right(self.level_roles, (low, float('inf')))
+        end = bisect_right(self.level_roles, (high, float('inf')))
+        return [role_id for _, role_id in self.level_roles[start:end]]
+
+    def xp_for_channel(self, channel_id):
+        multiplier = self.channel_multipliers.get(channel_id)
+        if multiplier is None:
+            return self.xp_per_message
+        return int(self.xp_per_message * multiplier)
+
+
+class GuildSettingsCache:
+    def __init__(self, maxsize=10000, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Bumped by invalidate, so a load that started before a settings change can't cache what it read.
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self, guild_id):
+        return self._generations.get(guild_id, 0)
+
+    def get(self, guild_id):
+        entry = self._entries.get(guild_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(guild_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, guild_id, settings, generation=None):
+        if generation is not None and generation != self.generation(guild_id):
+            return
+        self._entries[guild_id] = (time.monotonic() + self.ttl, settings)
+        self._entries.move_to_end(guild_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, guild_id):
+        self._entries.pop(guild_id, None)
+        self._generations[guild_id] = self.generation(guild_id) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+class CooldownIndex:
+    def __init__(self, horizon=3600, bucket_seconds=60):
+        # Entries older than the longest allowed cooldown can never reject a message,
+        # so they are dropped a whole time bucket at a time.
+        self.horizon = horizon
+        self.bucket_seconds = bucket_seconds
+        self.checks = 0
+        self.rejected = 0
+        self._last = {}
+        self._buckets = {}
+        self._pruned_bucket = 0
+
+    def __len__(self):
+        return len(self._last)
+
+    def check(self, key, now, cooldown_seconds):
+        self.checks += 1
+        last = self._last.get(key)
+        if last is not None and now - last < cooldown_seconds:
+            self.rejected += 1
+            return True
+        return False
+
+    def record(self, key, timestamp):
+        last = self._last.get(key)
+        if last is not None:
+            if last >= timestamp:
+                return
+            self._buckets[last // self.bucket_seconds].discard(key)
+        bucket = timestamp // self.bucket_seconds
+        self._last[key] = timestamp
+        self._buckets.setdefault(bucket, set()).add(key)
+        if bucket > self._pruned_bucket:
+            self.prune(timestamp)
+
+    def prune(self, now):
+        cutoff = (now - self.horizon) // self.bucket_seconds
+        for bucket in [b for b in self._buckets if b < cutoff]:
+            for key in self._buckets.pop(bucket):
+                del self._last[key]
+        self._pruned_bucket = now // self.bucket_seconds
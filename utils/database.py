@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+logger = logging.getLogger('discord')
+
+
+async def _pragma(conn, sql):
+    # PRAGMAs that report a value leave their statement open until it's read, and an
+    # open statement holds a lock other connections will wait on.
+    async with conn.execute(sql) as cursor:
+        await cursor.fetchall()
+
+
+class Database:
+    def __init__(self, path, read_pool_size=0, statement_cache_size=256, mmap_size=256 * 1024 * 1024):
+        self.path = path
+        # In-memory databases are private to one connection, so readers would see an empty db.
+        self.read_pool_size = 0 if path == ':memory:' else read_pool_size
+        self.statement_cache_size = statement_cache_size
+        self.mmap_size = mmap_size
+        self._writer = None
+        self._readers = []
+        self._reader_cycle = None
+        self._write_lock = asyncio.Lock()
+
+    async def _open(self, *pragmas):
+        # cached_statements is sqlite3's per-connection prepared statement cache;
+        # long-lived connections are what make it pay off.
+        conn = await aiosqlite.connect(self.path, cached_statements=self.statement_cache_size)
+        try:
+            # Under WAL, NORMAL can only lose the latest commits on power loss, never corrupt, and skips an fsync per commit.
+            for sql in ("PRAGMA synchronous=NORMAL", f"PRAGMA mmap_size={int(self.mmap_size)}", *pragmas):
+                await _pragma(conn, sql)
+        except BaseException:
+            # Each connection owns a non-daemon thread that would keep the process alive.
+            await conn.close()
+            raise
+        return conn
+
+    async def connect(self):
+        try:
+            self._writer = await self._open("PRAGMA journal_mode=WAL")
+            for _ in range(self.read_pool_size):
+                self._readers.append(await self._open("PRAGMA query_only=ON"))
+        except BaseException:
+            await self.close()
+            raise
+        if self._readers:
+            self._reader_cycle = itertools.cycle(self._readers)
+        logger.info(f"Opened database {self.path} with {len(self._readers)} read connection(s).")
+
+    async def close(self):
+        for reader in self._readers:
+            await reader.close()
+        self._readers.clear()
+        self._reader_cycle = None
+        if self._writer is not None:
+            async with self._write_lock:
+                await self._writer.close()
+            self._writer = None
+
+    def _reader(self):
+        if self._reader_cycle is not None:
+            return next(self._reader_cycle)
+        return self._writer
+
+    async def fetchone(self, sql, params=()):
+        async with self._reader().execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self._reader().execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def iterate(self, sql, params=(), batch_size=1000):
+        # Yields lists of at most batch_size rows without materialising the whole result.
+        async with self._reader().execute(sql, params) as cursor:
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+
+    async def execute(self, sql, params=()):
+        async with self._write_lock:
+            await self._writer.execute(sql, params)
+            await self._writer.commit()
+
+    async def executemany(self, sql, seq_of_params):
+        async with self._write_lock:
+            await self._writer.executemany(sql, seq_of_params)
+            await self._writer.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
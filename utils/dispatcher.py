@@ -0,0 +1,173 @@
+import asyncio
+import logging
+
+import discord
+
+logger = logging.getLogger('discord')
+
+MESSAGE_LIMIT = 2000
+
+
+def _chunk_lines(lines, limit=MESSAGE_LIMIT):
+    chunk = []
+    size = 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > limit:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        yield "\n".join(chunk)
+
+
+class SideEffectDispatcher:
+    """Sends level-up announcements and role grants off the XP path.
+
+    Announcements are queued per target channel and everything queued within
+    `window` seconds goes out as one message. Role grants are queued per guild
+    and merged per member into a single add_roles call. Each channel and guild
+    has at most one worker, so a slow or rate-limited route only delays itself.
+    """
+
+    def __init__(self, metrics, window=1.5, max_pending=5000, max_retries=3, backoff=1.0):
+        self.metrics = metrics
+        self.window = window
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pending = 0
+        # channel_id -> (channel, [(text, fallback_channel)])
+        self._announcements = {}
+        # guild_id -> {member_id: (member, {role_id: role}, reason)}
+        self._roles = {}
+        self._workers = {}
+
+    def _admit(self):
+        if self.pending >= self.max_pending:
+            self.metrics.inc('side_effects_dropped')
+            return False
+        self.pending += 1
+        self.metrics.inc('side_effects_enqueued')
+        return True
+
+    def announce(self, channel, text, fallback=None):
+        # fallback receives the text if `channel` turns out to be unusable.
+        if not self._admit():
+            return False
+        queued = self._announcements.get(channel.id)
+        if queued is None:
+            queued = self._announcements[channel.id] = (channel, [])
+        queued[1].append((text, fallback))
+        self._ensure_worker(('channel', channel.id), self._announce_worker(channel.id))
+        return True
+
+    def grant_role(self, member, role, reason=None):
+        guild_queue = self._roles.get(member.guild.id, {})
+        queued = guild_queue.get(member.id)
+        if queued is not None and role.id in queued[1]:
+            return True
+        if not self._admit():
+            return False
+        if queued is None:
+            queued = self._roles.setdefault(member.guild.id, guild_queue)[member.id] = (member, {}, reason)
+        queued[1][role.id] = role
+        self._ensure_worker(('guild', member.guild.id), self._role_worker(member.guild.id))
+        return True
+
+    def _ensure_worker(self, key, coro):
+        # A worker that has left its loop is done before its callback forgets it, and won't see new items.
+        worker = self._workers.get(key)
+        if worker is not None and not worker.done():
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._workers[key] = task
+
+        def forget(_):
+            if self._workers.get(key) is task:
+                del self._workers[key]
+        task.add_done_callback(forget)
+
+    async def stop(self, timeout=10.0):
+        # Let queued work drain for up to `timeout` seconds, then drop whatever is left.
+        workers = list(self._workers.values())
+        if workers:
+            _, still_running = await asyncio.wait(workers, timeout=timeout)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+        if self.pending:
+            logger.warning(f"Dropped {self.pending} queued level-up side effect(s) on shutdown.")
+        self._announcements.clear()
+        self._roles.clear()
+        self.pending = 0
+
+    async def request(self, label, make_request):
+        # Runs a Discord call, retrying rate limits and server errors with backoff.
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.metrics.timer('dispatch', label):
+                    return await make_request()
+            except discord.RateLimited as e:
+                delay = e.retry_after
+            except discord.HTTPException as e:
+                if isinstance(e, (discord.Forbidden, discord.NotFound)) or (e.status != 429 and e.status < 500):
+                    raise
+                delay = self.backoff * 2 ** attempt
+            if attempt == self.max_retries:
+                raise
+            self.metrics.inc('side_effect_retries')
+            await asyncio.sleep(delay)
+
+    async def _announce_worker(self, channel_id):
+        while channel_id in self._announcements:
+            await asyncio.sleep(self.window)
+            channel, entries = self._announcements.pop(channel_id)
+            self.pending -= len(entries)
+            if len(entries) > 1:
+                self.metrics.inc('announcements_coalesced', len(entries) - 1)
+            try:
+                for content in _chunk_lines([text for text, _ in entries]):
+                    await self.request('announce', lambda: channel.send(content))
+                    self.metrics.inc('announcements_sent')
+            except discord.HTTPException as e:
+                logger.warning(f"Could not send level up message to {channel_id} ({e.status}); falling back.")
+                await self._announce_fallback(entries)
+            except Exception as e:
+                self.metrics.inc('side_effect_failures')
+                logger.error(f"Error sending level up message to {channel_id}: {e}")
+
+    async def _announce_fallback(self, entries):
+        by_channel = {}
+        for text, fallback in entries:
+            if fallback is not None:
+                by_channel.setdefault(fallback.id, (fallback, []))[1].append(f"{text} (Couldn't send to configured channel.)")
+        if not by_channel:
+            self.metrics.inc('side_effect_failures', len(entries))
+        for fallback, lines in by_channel.values():
+            try:
+                for content in _chunk_lines(lines):
+                    await self.request('announce', lambda: fallback.send(content))
+                    self.metrics.inc('announcements_sent')
+            except Exception as e:
+                self.metrics.inc('side_effect_failures')
+                logger.error(f"Error sending fallback level up message to {fallback.id}: {e}")
+
+    async def _role_worker(self, guild_id):
+        while self._roles.get(guild_id):
+            await asyncio.sleep(self.window)
+            members = self._roles.pop(guild_id)
+            for member, roles, reason in members.values():
+                self.pending -= len(roles)
+                missing = [role for role in roles.values() if member.get_role(role.id) is None]
+                if not missing:
+                    continue
+                try:
+                    await self.request('roles', lambda: member.add_roles(*missing, reason=reason))
+                    self.metrics.inc('role_batches')
+                    self.metrics.inc('roles_granted', len(missing))
+                    logger.info(f"Assigned role(s) {', '.join(role.name for role in missing)} to {member.name}.")
+                except Exception as e:
+                    self.metrics.inc('side_effect_failures')
+                    logger.error(f"Error assigning role(s) to {member.name} in guild {guild_id}: {e}")
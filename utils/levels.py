@@ -0,0 +1,20 @@
+from math import isqrt
+
+
+def xp_for_level(level):
+    # Total XP needed to reach `level`.
+    if level < 0:
+        return 0
+    return int(5 * (level ** 2) + 50 * level + 100)
+
+
+def level_for_xp(xp):
+    # Closed-form inverse of xp_for_level, so recomputing a level costs the same at any XP.
+    if xp < xp_for_level(1):
+        return 0
+    level = (isqrt(500 + 20 * xp) - 50) // 10
+    while xp_for_level(level + 1) <= xp:
+        level += 1
+    while level > 0 and xp_for_level(level) > xp:
+        level -= 1
+    return level
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger('discord')
+
+# Upper bounds in seconds; the last bucket catches everything slower.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation; coarse, but free to compute.
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self, prefix='leveling'):
+        self.prefix = prefix
+        self.started = time.monotonic()
+        self.counters = {}
+        # (family, label) -> Histogram, e.g. ('stage', 'user_fetch') or ('db', 'get_user')
+        self.histograms = {}
+        self._collectors = []
+
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, family, label, seconds):
+        histogram = self.histograms.get((family, label))
+        if histogram is None:
+            histogram = self.histograms[(family, label)] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, family, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(family, label, time.perf_counter() - start)
+
+    def add_collector(self, collect):
+        # collect() returns {name: value} for gauges that live on other objects, read at export time.
+        self._collectors.append(collect)
+
+    def gauges(self):
+        values = {'uptime_seconds': time.monotonic() - self.started}
+        for collect in self._collectors:
+            values.update(collect())
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.append(f"{self.prefix}_{name}_total {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        families = {}
+        for (family, label), histogram in sorted(self.histograms.items()):
+            families.setdefault(family, []).append((label, histogram))
+        for family, members in families.items():
+            metric = f"{self.prefix}_{family}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for label, histogram in members:
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_bucket{{op="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{op="{label}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{op="{label}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedStorage:
+    """Wraps a Storage so every call is counted and timed under the 'db' histogram family."""
+
+    def __init__(self, storage, metrics):
+        self._storage = storage
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def timed(*args, **kwargs):
+            self._metrics.inc('db_ops')
+            with self._metrics.timer('db', name):
+                return await attr(*args, **kwargs)
+        return timed
+
+
+class MetricsExporter:
+    """Serves Metrics in Prometheus text format over local HTTP and/or rewrites a textfile periodically."""
+
+    def __init__(self, metrics, port=None, host='127.0.0.1', path=None, interval=15.0):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.path = path
+        self.interval = interval
+        self._server = None
+        self._task = None
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Serving leveling metrics on http://{self.host}:{self.port}/metrics")
+        if self.path:
+            self._task = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                self.write()
+            except OSError as e:
+                logger.error(f"Failed to write leveling metrics to {self.path}: {e}")
+
+    def write(self):
+        # Write-then-rename so scrapers never see a half-written file.
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.metrics.render_prometheus())
+        os.replace(tmp, self.path)
+
+    async def _write_loop(self):
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                logger.error(f"Failed to write leveling metrics to {self.path}: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _handle(self, reader, writer):
+        try:
+            # Any request gets the metrics; the headers aren't needed.
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            body = self.metrics.render_prometheus().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
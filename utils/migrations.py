@@ -0,0 +1,166 @@
+import json
+import logging
+
+logger = logging.getLogger('discord')
+
+
+async def _create_base_tables(db):
+    # Databases created before versioning already have these tables.
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            xp INTEGER DEFAULT 0,
+            level INTEGER DEFAULT 0,
+            last_message_timestamp INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, guild_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id INTEGER PRIMARY KEY,
+            level_up_channel_id INTEGER,
+            xp_per_message INTEGER DEFAULT 15,
+            cooldown_seconds INTEGER DEFAULT 60,
+            level_roles TEXT DEFAULT '{}',
+            channel_multipliers TEXT DEFAULT '{}'
+        )
+    ''')
+
+
+def _json_entries(guild_id, name, blob, convert):
+    # Skips only what can't be read, so one bad entry doesn't cost the guild the rest.
+    try:
+        items = json.loads(blob or '{}').items()
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning(f"Dropping unreadable {name} for guild {guild_id}: {e}")
+        return []
+    entries = []
+    for key, value in items:
+        try:
+            entries.append((guild_id, *convert(key, value)))
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Dropping unreadable {name} entry {key!r} for guild {guild_id}: {e}")
+    return entries
+
+
+async def _normalize_guild_settings(db):
+    await db.execute('''
+        CREATE TABLE level_roles (
+            guild_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, level)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        CREATE TABLE channel_multipliers (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            multiplier REAL NOT NULL,
+            PRIMARY KEY (guild_id, channel_id)
+        ) WITHOUT ROWID
+    ''')
+    roles, multipliers = [], []
+    async with db.execute("SELECT guild_id, level_roles, channel_multipliers FROM guild_settings") as cursor:
+        async for guild_id, level_roles, channel_multipliers in cursor:
+            roles.extend(_json_entries(guild_id, "level roles", level_roles,
+                                       lambda lvl, role_id: (int(lvl), int(role_id))))
+            multipliers.extend(_json_entries(guild_id, "channel multipliers", channel_multipliers,
+                                             lambda ch_id, mult: (int(ch_id), float(mult))))
+    await db.executemany("INSERT OR REPLACE INTO level_roles (guild_id, level, role_id) VALUES (?, ?, ?)", roles)
+    await db.executemany("INSERT OR REPLACE INTO channel_multipliers (guild_id, channel_id, multiplier) VALUES (?, ?, ?)", multipliers)
+
+    # SQLite can't drop columns portably, so rebuild guild_settings without the JSON blobs.
+    # The old table is kept as guild_settings_v1, so anything skipped above can still be recovered.
+    await db.execute("ALTER TABLE guild_settings RENAME TO guild_settings_v1")
+    await db.execute('''
+        CREATE TABLE guild_settings (
+            guild_id INTEGER PRIMARY KEY,
+            level_up_channel_id INTEGER,
+            xp_per_message INTEGER NOT NULL DEFAULT 15,
+            cooldown_seconds INTEGER NOT NULL DEFAULT 60
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO guild_settings (guild_id, level_up_channel_id, xp_per_message, cooldown_seconds)
+        SELECT guild_id, level_up_channel_id, COALESCE(xp_per_message, 15), COALESCE(cooldown_seconds, 60) FROM guild_settings_v1
+    ''')
+
+
+async def _add_indexes(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_guild_xp ON users (guild_id, xp DESC)")
+
+
+async def _add_activity_xp(db):
+    await db.execute("ALTER TABLE guild_settings ADD COLUMN voice_xp_per_minute INTEGER NOT NULL DEFAULT 0")
+    await db.execute("ALTER TABLE guild_settings ADD COLUMN reaction_xp INTEGER NOT NULL DEFAULT 0")
+
+
+async def _add_role_sync(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_guild_level ON users (guild_id, level)")
+    await db.execute('''
+        CREATE TABLE role_sync_jobs (
+            guild_id INTEGER PRIMARY KEY,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            granted INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+
+async def _add_xp_periods(db):
+    # XP earned per user in each day/week/month bucket; the rank index covers every
+    # column a period leaderboard reads, so those queries never touch the table.
+    await db.execute('''
+        CREATE TABLE xp_periods (
+            guild_id INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            xp INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, period, bucket, user_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute("CREATE INDEX idx_xp_periods_rank ON xp_periods (guild_id, period, bucket, xp DESC)")
+
+
+async def _add_activity_index(db):
+    # Warm-up's recent_users reads only recently active users; user_id makes the index covering.
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_guild_activity ON users (guild_id, last_message_timestamp, user_id)")
+
+
+async def _add_period_prune_index(db):
+    # Lets the hourly prune of expired buckets seek to them instead of scanning every guild.
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_xp_periods_bucket ON xp_periods (period, bucket)")
+
+
+# Append only; a database at user_version N has run MIGRATIONS[:N].
+MIGRATIONS = [
+    _create_base_tables,
+    _normalize_guild_settings,
+    _add_indexes,
+    _add_activity_xp,
+    _add_role_sync,
+    _add_xp_periods,
+    _add_activity_index,
+    _add_period_prune_index,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def migrate(database):
+    async with database.transaction() as db:
+        # sqlite3 only opens transactions implicitly for DML; DDL must be covered too.
+        await db.execute("BEGIN")
+        async with db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema version {version} is newer than this build supports ({SCHEMA_VERSION}).")
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying database migration {number}: {migration.__name__.strip('_')}")
+            await migration(db)
+            # PRAGMA doesn't accept bound parameters.
+            await db.execute(f"PRAGMA user_version = {number}")
+    return version
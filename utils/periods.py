@@ -0,0 +1,36 @@
+import calendar
+import datetime
+
+# Stored as small integers in xp_periods.period.
+PERIODS = {'daily': 0, 'weekly': 1, 'monthly': 2}
+PERIOD_TITLES = {'daily': "Today", 'weekly': "This Week", 'monthly': "This Month"}
+
+DAY = 86400
+
+
+def bucket_for(period, timestamp):
+    """The UTC day, Monday-start week or month containing `timestamp`, as an increasing integer."""
+    days = int(timestamp) // DAY
+    if period == 'daily':
+        return days
+    if period == 'weekly':
+        # 1970-01-01 was a Thursday; shift so buckets start on Monday.
+        return (days + 3) // 7
+    date = datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc)
+    return date.year * 12 + date.month - 1
+
+
+def bucket_start(period, bucket):
+    if period == 'daily':
+        return bucket * DAY
+    if period == 'weekly':
+        return (bucket * 7 - 3) * DAY
+    return calendar.timegm((bucket // 12, bucket % 12 + 1, 1, 0, 0, 0))
+
+
+def bucket_end(period, bucket):
+    return bucket_start(period, bucket + 1)
+
+
+def period_rows(periods, guild_id, user_id, xp, timestamp):
+    return [(guild_id, PERIODS[period], bucket_for(period, timestamp), user_id, xp) for period in periods]
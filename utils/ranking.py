@@ -0,0 +1,136 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+LEADERBOARD_PAGE_SIZE = 10
+
+
+class GuildRanking:
+    stale = False
+
+    def __init__(self, rows=()):
+        # rows are (user_id, xp); only users with xp > 0 are ranked
+        self._xp = {user_id: xp for user_id, xp in rows if xp > 0}
+        self._sorted = sorted(self._xp.values())
+
+    @property
+    def total(self):
+        return len(self._sorted)
+
+    def update(self, user_id, xp, level=None):
+        old = self._xp.get(user_id)
+        if old == xp:
+            return
+        if old is not None:
+            del self._sorted[bisect_left(self._sorted, old)]
+        if xp > 0:
+            insort(self._sorted, xp)
+            self._xp[user_id] = xp
+        else:
+            self._xp.pop(user_id, None)
+
+    def rank(self, xp):
+        return len(self._sorted) - bisect_right(self._sorted, xp) + 1
+
+
+class GuildLeaderboard:
+    def __init__(self, rows, size):
+        # rows are (user_id, xp, level) for at most `size` users, highest XP first
+        self.size = size
+        self.complete = len(rows) < size
+        self.stale = False
+        self.pages = {}
+        self._entries = sorted((-xp, user_id, level) for user_id, xp, level in rows if xp > 0)[:size]
+        self._members = {entry[1]: entry for entry in self._entries}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def page_count(self):
+        return max(1, -(-len(self._entries) // LEADERBOARD_PAGE_SIZE))
+
+    def page(self, page):
+        start = page * LEADERBOARD_PAGE_SIZE
+        return [(start + i + 1, user_id, -neg_xp, level)
+                for i, (neg_xp, user_id, level) in enumerate(self._entries[start:start + LEADERBOARD_PAGE_SIZE])]
+
+    def update(self, user_id, xp, level=None):
+        old = self._members.get(user_id)
+        entry = (-xp, user_id, level)
+        if old == entry:
+            return
+        if old is not None and not self.complete and xp < -old[0]:
+            # The user may now belong below someone we never loaded.
+            self.stale = True
+            return
+        page_count = self.page_count
+        removed_at = inserted_at = None
+        if old is not None:
+            removed_at = bisect_left(self._entries, old)
+            del self._entries[removed_at]
+            del self._members[user_id]
+        if xp > 0 and (len(self._entries) < self.size or entry < self._entries[-1]):
+            inserted_at = bisect_left(self._entries, entry)
+            self._entries.insert(inserted_at, entry)
+            self._members[user_id] = entry
+            if len(self._entries) > self.size:
+                dropped = self._entries.pop()
+                del self._members[dropped[1]]
+                self.complete = False
+        if removed_at is None and inserted_at is None:
+            return
+        if self.page_count != page_count:
+            # Rendered pages carry the page count, so every one of them is out of date.
+            self.pages.clear()
+            return
+        # A move only shifts the rows between its two positions; an insert or removal
+        # shifts everything below it.
+        if removed_at is not None and inserted_at is not None:
+            lo, hi = min(removed_at, inserted_at), max(removed_at, inserted_at)
+        else:
+            lo, hi = removed_at if inserted_at is None else inserted_at, self.size
+        for page in range(lo // LEADERBOARD_PAGE_SIZE, hi // LEADERBOARD_PAGE_SIZE + 1):
+            self.pages.pop(page, None)
+
+
+class GuildIndex:
+    def __init__(self, max_guilds=1000):
+        self.max_guilds = max_guilds
+        self._guilds = OrderedDict()
+        self._building = {}
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def get(self, guild_id):
+        value = self._guilds.get(guild_id)
+        if value is None:
+            return None
+        if value.stale:
+            del self._guilds[guild_id]
+            return None
+        self._guilds.move_to_end(guild_id)
+        return value
+
+    def begin_build(self, guild_id):
+        # Updates that land while the guild is being loaded are replayed onto the result.
+        self._building.setdefault(guild_id, [])
+
+    def put(self, guild_id, value):
+        for update in self._building.pop(guild_id, ()):
+            value.update(*update)
+        self._guilds[guild_id] = value
+        self._guilds.move_to_end(guild_id)
+        while len(self._guilds) > self.max_guilds:
+            self._guilds.popitem(last=False)
+
+    def update(self, guild_id, user_id, xp, level):
+        value = self._guilds.get(guild_id)
+        if value is not None:
+            value.update(user_id, xp, level)
+        elif guild_id in self._building:
+            self._building[guild_id].append((user_id, xp, level))
+
+    def invalidate(self, guild_id):
+        self._guilds.pop(guild_id, None)
+        self._building.pop(guild_id, None)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('discord')
+
+CHECKPOINT_EVERY = 50
+
+
+class RoleSyncJob:
+    """Gives every member the level roles they should already have.
+
+    One query fetches everyone at or above the lowest rewarded level, the
+    wanted roles are diffed against the cached member roles, and only the
+    missing ones are requested, at most `rate` add_roles calls per second.
+    Progress is checkpointed by user id, so a stopped or interrupted job picks
+    up where it left off.
+    """
+
+    def __init__(self, guild, storage, settings, request, rate=1.0, last_user_id=0, granted=0):
+        self.guild = guild
+        self.storage = storage
+        self.settings = settings
+        self.request = request
+        self.rate = rate
+        self.last_user_id = last_user_id
+        self.granted = granted
+        self.total = 0
+        self.checked = 0
+        self.not_cached = 0
+        self.failed = 0
+        self.done = False
+        self.task = None
+        self._next_call = 0.0
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def stop(self):
+        if self.running:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def progress_text(self):
+        state = "✅ Finished" if self.done else ("🔄 Running" if self.running else "⏸️ Stopped")
+        text = f"{state} · checked `{self.checked:,}/{self.total:,}` members · granted `{self.granted:,}` role(s)"
+        if self.not_cached:
+            text += f" · `{self.not_cached:,}` not in the member cache"
+        if self.failed:
+            text += f" · `{self.failed:,}` failed"
+        return text
+
+    def missing_roles(self, member, level):
+        me = self.guild.me
+        roles = []
+        for role_id in self.settings.roles_between(0, level):
+            if member.get_role(role_id) is not None:
+                continue
+            role = self.guild.get_role(role_id)
+            if role is not None and role <= me.top_role:
+                roles.append(role)
+        return roles
+
+    async def _throttle(self):
+        now = time.monotonic()
+        if self._next_call > now:
+            await asyncio.sleep(self._next_call - now)
+        self._next_call = max(now, self._next_call) + 1 / self.rate
+
+    async def _run(self):
+        guild_id = self.guild.id
+        if not self.settings.level_roles:
+            await self.storage.delete_role_sync(guild_id)
+            self.done = True
+            return
+        await self.storage.save_role_sync(guild_id, self.last_user_id, self.granted)
+        rows = sorted(await self.storage.leveled_users(guild_id, self.settings.level_roles[0][0]))
+        self.total = len(rows)
+        self.checked = sum(1 for user_id, _ in rows if user_id <= self.last_user_id)
+        try:
+            for user_id, level in rows:
+                if user_id <= self.last_user_id:
+                    continue
+                member = self.guild.get_member(user_id)
+                if member is None:
+                    self.not_cached += 1
+                else:
+                    roles = self.missing_roles(member, level)
+                    if roles:
+                        await self._throttle()
+                        try:
+                            await self.request('role_sync', lambda: member.add_roles(*roles, reason="Level role sync"))
+                            self.granted += len(roles)
+                        except Exception as e:
+                            self.failed += 1
+                            logger.warning(f"Level role sync could not update {member} in guild {guild_id}: {e}")
+                self.checked += 1
+                self.last_user_id = user_id
+                if self.checked % CHECKPOINT_EVERY == 0:
+                    await self.storage.save_role_sync(guild_id, self.last_user_id, self.granted)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.storage.save_role_sync(guild_id, self.last_user_id, self.granted))
+            raise
+        await self.storage.delete_role_sync(guild_id)
+        self.done = True
+        logger.info(f"Level role sync for guild {guild_id} finished: {self.progress_text()}")
@@ -0,0 +1,328 @@
+"""Shared XP state for multi-process sharding.
+
+One aggregator process owns the database and serves the Storage interface
+over a Unix socket; every shard process talks to it through RemoteStorage.
+Writes from all shards are group-committed, so the database sees a single
+writer no matter how many shards there are. Messages are newline-delimited
+JSON (not pickle), so a client can't get the service to run code.
+"""
+import asyncio
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import signal
+
+from utils.cache import GuildSettings
+from utils.storage import Storage, open_storage
+
+logger = logging.getLogger('discord')
+
+LINE_LIMIT = 64 * 1024 * 1024
+
+# Storage methods a client may call; anything else is rejected.
+SERVED_METHODS = {
+    'get_user', 'get_users', 'rank', 'guild_xp', 'top_users', 'count_ranked', 'recent_users', 'delete_guild_users',
+    'get_guild_settings', 'update_guild_settings', 'set_level_role', 'remove_level_role',
+    'set_channel_multiplier', 'remove_channel_multiplier', 'leveled_users',
+    'save_role_sync', 'delete_role_sync', 'pending_role_syncs',
+    'period_top', 'period_count', 'period_rank', 'prune_period_xp',
+}
+
+
+class StateServiceError(RuntimeError):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, GuildSettings):
+        return dataclasses.asdict(value)
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+class StateService:
+    def __init__(self, storage, max_batch_rows=20000):
+        self.storage = storage
+        self.max_batch_rows = max_batch_rows
+        self.commits = 0
+        self.batches = 0
+        self._writes = asyncio.Queue()
+        self._cursors = {}
+        self._cursor_ids = itertools.count(1)
+        self._server = None
+        self._writer_task = None
+
+    async def start(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._handle, path, limit=LINE_LIMIT)
+        os.chmod(path, 0o600)
+        self._writer_task = asyncio.create_task(self._write_loop())
+        logger.info(f"XP state service listening on {path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._writer_task is not None:
+            await self._writes.join()
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        for cursor in self._cursors.values():
+            await cursor.aclose()
+        self._cursors.clear()
+
+    async def upsert_users(self, rows, period_rows=()):
+        done = asyncio.get_running_loop().create_future()
+        await self._writes.put((rows, period_rows, done))
+        return await done
+
+    async def _write_loop(self):
+        # Group commit: everything queued while the previous transaction ran goes into the next one.
+        while True:
+            batches = [await self._writes.get()]
+            size = len(batches[0][0])
+            while size < self.max_batch_rows and not self._writes.empty():
+                batches.append(self._writes.get_nowait())
+                size += len(batches[-1][0])
+            merged = {}
+            # Period rows are increments, so they add up instead of replacing each other.
+            periods = {}
+            for rows, period_rows, _ in batches:
+                for row in rows:
+                    merged[(row[0], row[1])] = row
+                for *key, xp in period_rows:
+                    periods[tuple(key)] = periods.get(tuple(key), 0) + xp
+            try:
+                await self.storage.upsert_users(list(merged.values()), [(*key, xp) for key, xp in periods.items()])
+            except Exception as e:
+                for *_, done in batches:
+                    if not done.done():
+                        done.set_exception(e)
+            else:
+                self.commits += 1
+                self.batches += len(batches)
+                for *_, done in batches:
+                    if not done.done():
+                        done.set_result(None)
+            finally:
+                for _ in batches:
+                    self._writes.task_done()
+
+    async def _dispatch(self, method, args, kwargs):
+        if method == 'upsert_users':
+            period_rows = args[1] if len(args) > 1 else ()
+            return await self.upsert_users([tuple(row) for row in args[0]], [tuple(row) for row in period_rows])
+        if method == 'iter_open':
+            cursor_id = next(self._cursor_ids)
+            self._cursors[cursor_id] = self.storage.iter_guild_users(*args, **kwargs).__aiter__()
+            return cursor_id
+        if method == 'iter_next':
+            cursor = self._cursors.get(args[0])
+            if cursor is None:
+                return []
+            try:
+                return await cursor.__anext__()
+            except StopAsyncIteration:
+                del self._cursors[args[0]]
+                return []
+        if method == 'iter_close':
+            cursor = self._cursors.pop(args[0], None)
+            if cursor is not None:
+                await cursor.aclose()
+            return None
+        if method not in SERVED_METHODS:
+            raise StateServiceError(f"Unknown state service method {method!r}")
+        return await getattr(self.storage, method)(*args, **kwargs)
+
+    async def _respond(self, request, writer, lock):
+        try:
+            result = await self._dispatch(request['method'], request.get('args', []), request.get('kwargs', {}))
+            response = {'id': request['id'], 'result': result}
+        except Exception as e:
+            response = {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+        async with lock:
+            writer.write(json.dumps(response, default=_encode).encode() + b"\n")
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        pending = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._respond(json.loads(line), writer, lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            writer.close()
+
+
+class RemoteStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+    async def _read_loop(self):
+        try:
+            while line := await self._reader.readline():
+                response = json.loads(line)
+                done = self._pending.pop(response['id'], None)
+                if done is None or done.done():
+                    continue
+                if 'error' in response:
+                    done.set_exception(StateServiceError(response['error']))
+                else:
+                    done.set_result(response['result'])
+        finally:
+            for done in self._pending.values():
+                if not done.done():
+                    done.set_exception(ConnectionError("Lost connection to the XP state service"))
+            self._pending.clear()
+
+    async def _call(self, method, *args, **kwargs):
+        if self._writer is None:
+            raise ConnectionError("Not connected to the XP state service")
+        request_id = next(self._ids)
+        done = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = done
+        self._writer.write(json.dumps({'id': request_id, 'method': method, 'args': args, 'kwargs': kwargs}).encode() + b"\n")
+        await self._writer.drain()
+        return await done
+
+    async def get_user(self, guild_id, user_id):
+        row = await self._call('get_user', guild_id, user_id)
+        return tuple(row) if row is not None else None
+
+    async def get_users(self, guild_id, user_ids):
+        found = await self._call('get_users', guild_id, list(user_ids))
+        return {int(user_id): tuple(row) for user_id, row in found.items()}
+
+    async def upsert_users(self, rows, period_rows=()):
+        await self._call('upsert_users', list(rows), list(period_rows))
+
+    async def rank(self, guild_id, xp):
+        return tuple(await self._call('rank', guild_id, xp))
+
+    async def guild_xp(self, guild_id):
+        return [tuple(row) for row in await self._call('guild_xp', guild_id)]
+
+    async def top_users(self, guild_id, limit, offset=0):
+        return [tuple(row) for row in await self._call('top_users', guild_id, limit, offset)]
+
+    async def count_ranked(self, guild_id):
+        return await self._call('count_ranked', guild_id)
+
+    async def period_top(self, guild_id, period, bucket, limit, offset=0):
+        return [tuple(row) for row in await self._call('period_top', guild_id, period, bucket, limit, offset)]
+
+    async def period_count(self, guild_id, period, bucket):
+        return await self._call('period_count', guild_id, period, bucket)
+
+    async def period_rank(self, guild_id, period, bucket, user_id):
+        row = await self._call('period_rank', guild_id, period, bucket, user_id)
+        return tuple(row) if row is not None else None
+
+    async def prune_period_xp(self, period, before_bucket):
+        await self._call('prune_period_xp', period, before_bucket)
+
+    async def recent_users(self, guild_id, since):
+        return [tuple(row) for row in await self._call('recent_users', guild_id, since)]
+
+    async def leveled_users(self, guild_id, min_level):
+        return [tuple(row) for row in await self._call('leveled_users', guild_id, min_level)]
+
+    async def iter_guild_users(self, guild_id, batch_size=1000):
+        cursor_id = await self._call('iter_open', guild_id, batch_size)
+        exhausted = False
+        try:
+            while rows := await self._call('iter_next', cursor_id):
+                yield [tuple(row) for row in rows]
+            exhausted = True
+        finally:
+            if not exhausted:
+                await self._call('iter_close', cursor_id)
+
+    async def delete_guild_users(self, guild_id):
+        await self._call('delete_guild_users', guild_id)
+
+    async def save_role_sync(self, guild_id, last_user_id, granted):
+        await self._call('save_role_sync', guild_id, last_user_id, granted)
+
+    async def delete_role_sync(self, guild_id):
+        await self._call('delete_role_sync', guild_id)
+
+    async def pending_role_syncs(self):
+        return [tuple(row) for row in await self._call('pending_role_syncs')]
+
+    async def get_guild_settings(self, guild_id):
+        data = await self._call('get_guild_settings', guild_id)
+        # JSON turns tuples into lists and int keys into strings; undo both.
+        data['level_roles'] = [tuple(pair) for pair in data['level_roles']]
+        data['channel_multipliers'] = {int(channel_id): multiplier for channel_id, multiplier in data['channel_multipliers'].items()}
+        return GuildSettings(**data)
+
+    async def update_guild_settings(self, guild_id, **values):
+        await self._call('update_guild_settings', guild_id, **values)
+
+    async def set_level_role(self, guild_id, level, role_id):
+        await self._call('set_level_role', guild_id, level, role_id)
+
+    async def remove_level_role(self, guild_id, level):
+        await self._call('remove_level_role', guild_id, level)
+
+    async def set_channel_multiplier(self, guild_id, channel_id, multiplier):
+        await self._call('set_channel_multiplier', guild_id, channel_id, multiplier)
+
+    async def remove_channel_multiplier(self, guild_id, channel_id):
+        await self._call('remove_channel_multiplier', guild_id, channel_id)
+
+
+async def serve(path, database_url, ready=None):
+    storage = open_storage(database_url)
+    await storage.connect()
+    service = StateService(storage)
+    await service.start(path)
+    if ready is not None:
+        ready.set()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    # Ctrl-C reaches every process in the group; keep serving until the launcher
+    # has stopped the workers and sends SIGTERM, so their final flushes land.
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    await stopping.wait()
+    await service.stop()
+    await storage.close()
+    logger.info(f"XP state service stopped after {service.commits} commit(s) covering {service.batches} batch(es).")
+
+
+def run_state_service(path, database_url, ready=None):
+    """Process entry point; `ready` is a multiprocessing.Event set once the socket accepts connections."""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(path, database_url, ready))
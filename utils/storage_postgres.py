@@ -0,0 +1,227 @@
+import logging
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from utils.cache import GuildSettings
+from utils.storage import Storage, settings_columns
+
+logger = logging.getLogger('discord')
+
+# Discord snowflakes need BIGINT; every shard process shares these tables.
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT NOT NULL,
+        guild_id BIGINT NOT NULL,
+        xp BIGINT NOT NULL DEFAULT 0,
+        level INTEGER NOT NULL DEFAULT 0,
+        last_message_timestamp BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, guild_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS guild_settings (
+        guild_id BIGINT PRIMARY KEY,
+        level_up_channel_id BIGINT,
+        xp_per_message INTEGER NOT NULL DEFAULT 15,
+        cooldown_seconds INTEGER NOT NULL DEFAULT 60
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS level_roles (
+        guild_id BIGINT NOT NULL,
+        level INTEGER NOT NULL,
+        role_id BIGINT NOT NULL,
+        PRIMARY KEY (guild_id, level)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS channel_multipliers (
+        guild_id BIGINT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        multiplier DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (guild_id, channel_id)
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_users_guild_xp ON users (guild_id, xp DESC)",
+    "ALTER TABLE guild_settings ADD COLUMN IF NOT EXISTS voice_xp_per_minute INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE guild_settings ADD COLUMN IF NOT EXISTS reaction_xp INTEGER NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_users_guild_level ON users (guild_id, level)",
+    "CREATE INDEX IF NOT EXISTS idx_users_guild_activity ON users (guild_id, last_message_timestamp) INCLUDE (user_id)",
+    '''
+    CREATE TABLE IF NOT EXISTS xp_periods (
+        guild_id BIGINT NOT NULL,
+        period SMALLINT NOT NULL,
+        bucket INTEGER NOT NULL,
+        user_id BIGINT NOT NULL,
+        xp BIGINT NOT NULL,
+        PRIMARY KEY (guild_id, period, bucket, user_id)
+    )
+    ''',
+    # INCLUDE makes period leaderboards and ranks index-only scans.
+    "CREATE INDEX IF NOT EXISTS idx_xp_periods_rank ON xp_periods (guild_id, period, bucket, xp DESC) INCLUDE (user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_xp_periods_bucket ON xp_periods (period, bucket)",
+    '''
+    CREATE TABLE IF NOT EXISTS role_sync_jobs (
+        guild_id BIGINT PRIMARY KEY,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        granted INTEGER NOT NULL DEFAULT 0,
+        updated_at BIGINT NOT NULL
+    )
+    ''',
+]
+
+
+class PostgresStorage(Storage):
+    def __init__(self, dsn, min_size=1, max_size=10, statement_cache_size=256):
+        if asyncpg is None:
+            raise RuntimeError("The PostgreSQL storage backend needs asyncpg: pip install -r requirements-postgres.txt")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self._pool = None
+
+    async def connect(self):
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size,
+                                               statement_cache_size=self.statement_cache_size)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                # Serialise schema setup between shards starting at the same time.
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('leveling_schema'))")
+                for statement in SCHEMA:
+                    await conn.execute(statement)
+        logger.info(f"Opened PostgreSQL pool with {self.min_size}-{self.max_size} connection(s).")
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def get_user(self, guild_id, user_id):
+        row = await self._pool.fetchrow("SELECT xp, level, last_message_timestamp FROM users WHERE user_id = $1 AND guild_id = $2", user_id, guild_id)
+        return tuple(row) if row else None
+
+    async def get_users(self, guild_id, user_ids):
+        rows = await self._pool.fetch("SELECT user_id, xp, level, last_message_timestamp FROM users WHERE guild_id = $1 AND user_id = ANY($2::bigint[])",
+                                      guild_id, list(user_ids))
+        return {row['user_id']: (row['xp'], row['level'], row['last_message_timestamp']) for row in rows}
+
+    async def upsert_users(self, rows, period_rows=()):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    "INSERT INTO users (guild_id, user_id, xp, level, last_message_timestamp) VALUES ($1, $2, $3, $4, $5) "
+                    "ON CONFLICT (user_id, guild_id) DO UPDATE SET xp = excluded.xp, level = excluded.level, "
+                    "last_message_timestamp = excluded.last_message_timestamp",
+                    rows)
+                if period_rows:
+                    await conn.executemany(
+                        "INSERT INTO xp_periods (guild_id, period, bucket, user_id, xp) VALUES ($1, $2, $3, $4, $5) "
+                        "ON CONFLICT (guild_id, period, bucket, user_id) DO UPDATE SET xp = xp_periods.xp + excluded.xp",
+                        period_rows)
+
+    async def rank(self, guild_id, xp):
+        above, total = await self._pool.fetchrow("SELECT COUNT(*) FILTER (WHERE xp > $2), COUNT(*) FROM users WHERE guild_id = $1 AND xp > 0", guild_id, xp)
+        return above + 1, total
+
+    async def guild_xp(self, guild_id):
+        return [tuple(row) for row in await self._pool.fetch("SELECT user_id, xp FROM users WHERE guild_id = $1 AND xp > 0", guild_id)]
+
+    async def top_users(self, guild_id, limit, offset=0):
+        rows = await self._pool.fetch("SELECT user_id, xp, level FROM users WHERE guild_id = $1 AND xp > 0 ORDER BY xp DESC, user_id LIMIT $2 OFFSET $3",
+                                      guild_id, limit, offset)
+        return [tuple(row) for row in rows]
+
+    async def count_ranked(self, guild_id):
+        return await self._pool.fetchval("SELECT COUNT(*) FROM users WHERE guild_id = $1 AND xp > 0", guild_id)
+
+    async def period_top(self, guild_id, period, bucket, limit, offset=0):
+        rows = await self._pool.fetch("SELECT user_id, xp FROM xp_periods WHERE guild_id = $1 AND period = $2 AND bucket = $3 "
+                                      "ORDER BY xp DESC, user_id LIMIT $4 OFFSET $5", guild_id, period, bucket, limit, offset)
+        return [tuple(row) for row in rows]
+
+    async def period_count(self, guild_id, period, bucket):
+        return await self._pool.fetchval("SELECT COUNT(*) FROM xp_periods WHERE guild_id = $1 AND period = $2 AND bucket = $3", guild_id, period, bucket)
+
+    async def period_rank(self, guild_id, period, bucket, user_id):
+        xp = await self._pool.fetchval("SELECT xp FROM xp_periods WHERE guild_id = $1 AND period = $2 AND bucket = $3 AND user_id = $4",
+                                       guild_id, period, bucket, user_id)
+        if xp is None:
+            return None
+        above, total = await self._pool.fetchrow("SELECT COUNT(*) FILTER (WHERE xp > $4), COUNT(*) FROM xp_periods WHERE guild_id = $1 AND period = $2 AND bucket = $3",
+                                                 guild_id, period, bucket, xp)
+        return xp, above + 1, total
+
+    async def prune_period_xp(self, period, before_bucket):
+        await self._pool.execute("DELETE FROM xp_periods WHERE period = $1 AND bucket < $2", period, before_bucket)
+
+    async def recent_users(self, guild_id, since):
+        rows = await self._pool.fetch("SELECT user_id, last_message_timestamp FROM users WHERE guild_id = $1 AND last_message_timestamp >= $2", guild_id, since)
+        return [tuple(row) for row in rows]
+
+    async def leveled_users(self, guild_id, min_level):
+        rows = await self._pool.fetch("SELECT user_id, level FROM users WHERE guild_id = $1 AND level >= $2", guild_id, min_level)
+        return [tuple(row) for row in rows]
+
+    async def iter_guild_users(self, guild_id, batch_size=1000):
+        # Server-side cursors only live inside a transaction.
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor("SELECT user_id, xp, level, last_message_timestamp FROM users WHERE guild_id = $1", guild_id)
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        return
+                    yield [tuple(row) for row in rows]
+
+    async def delete_guild_users(self, guild_id):
+        await self._pool.execute("DELETE FROM users WHERE guild_id = $1", guild_id)
+
+    async def save_role_sync(self, guild_id, last_user_id, granted):
+        await self._pool.execute(
+            "INSERT INTO role_sync_jobs (guild_id, last_user_id, granted, updated_at) VALUES ($1, $2, $3, EXTRACT(EPOCH FROM now())::bigint) "
+            "ON CONFLICT (guild_id) DO UPDATE SET last_user_id = excluded.last_user_id, granted = excluded.granted, updated_at = excluded.updated_at",
+            guild_id, last_user_id, granted)
+
+    async def delete_role_sync(self, guild_id):
+        await self._pool.execute("DELETE FROM role_sync_jobs WHERE guild_id = $1", guild_id)
+
+    async def pending_role_syncs(self):
+        return [tuple(row) for row in await self._pool.fetch("SELECT guild_id, last_user_id, granted FROM role_sync_jobs")]
+
+    async def get_guild_settings(self, guild_id):
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT level_up_channel_id, xp_per_message, cooldown_seconds, voice_xp_per_minute, reaction_xp FROM guild_settings WHERE guild_id = $1", guild_id)
+            if row is None:
+                await conn.execute("INSERT INTO guild_settings (guild_id) VALUES ($1) ON CONFLICT (guild_id) DO NOTHING", guild_id)
+                defaults = GuildSettings()
+                row = (defaults.level_up_channel_id, defaults.xp_per_message, defaults.cooldown_seconds, defaults.voice_xp_per_minute, defaults.reaction_xp)
+            role_rows = await conn.fetch("SELECT level, role_id FROM level_roles WHERE guild_id = $1", guild_id)
+            multiplier_rows = await conn.fetch("SELECT channel_id, multiplier FROM channel_multipliers WHERE guild_id = $1", guild_id)
+        return GuildSettings.from_rows(tuple(row), role_rows, multiplier_rows)
+
+    async def update_guild_settings(self, guild_id, **values):
+        columns = settings_columns(values)
+        placeholders = ', '.join(f'${i}' for i in range(2, len(columns) + 2))
+        await self._pool.execute(
+            f"INSERT INTO guild_settings (guild_id, {', '.join(columns)}) VALUES ($1, {placeholders}) "
+            f"ON CONFLICT (guild_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+            guild_id, *values.values())
+
+    async def set_level_role(self, guild_id, level, role_id):
+        await self._pool.execute("INSERT INTO level_roles (guild_id, level, role_id) VALUES ($1, $2, $3) ON CONFLICT (guild_id, level) DO UPDATE SET role_id = excluded.role_id",
+                                 guild_id, level, role_id)
+
+    async def remove_level_role(self, guild_id, level):
+        await self._pool.execute("DELETE FROM level_roles WHERE guild_id = $1 AND level = $2", guild_id, level)
+
+    async def set_channel_multiplier(self, guild_id, channel_id, multiplier):
+        await self._pool.execute("INSERT INTO channel_multipliers (guild_id, channel_id, multiplier) VALUES ($1, $2, $3) ON CONFLICT (guild_id, channel_id) DO UPDATE SET multiplier = excluded.multiplier",
+                                 guild_id, channel_id, multiplier)
+
+    async def remove_channel_multiplier(self, guild_id, channel_id):
+        await self._pool.execute("DELETE FROM channel_multipliers WHERE guild_id = $1 AND channel_id = $2", guild_id, channel_id)
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+logger = logging.getLogger('discord')
+
+# Snapshot layout: header, then per guild a (guild_id, count) record followed by
+# the id, xp, level and timestamp columns as raw arrays.
+SNAPSHOT_MAGIC = b'LVLSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sBBIQ')  # magic, valid, little-endian, guilds, written_at
+SNAPSHOT_GUILD = struct.Struct('<qI')
+VALID_OFFSET = 8
+COLUMN_TYPECODES = ('q', 'q', 'i', 'q')  # user_id, xp, level, last_message_timestamp
+
+
+def invalidate_snapshot(path):
+    """Mark a snapshot stale, e.g. before writing XP to the database from outside the bot."""
+    try:
+        with open(path, 'r+b') as f:
+            f.seek(VALID_OFFSET)
+            f.write(b'\x00')
+            f.flush()
+            os.fsync(f.fileno())
+    except FileNotFoundError:
+        pass
+
+
+class GuildUserState:
+    """One guild's users as parallel arrays sorted by user id, about 28 bytes per user.
+
+    New users land in a small dict first and are merged into the arrays once it
+    reaches 1/32 of their size, so growing a guild copies each row a bounded
+    number of times instead of once per join.
+    """
+
+    MIN_MERGE = 256
+
+    def __init__(self, columns=None):
+        self.ids, self.xp, self.level, self.ts = columns or tuple(array(code) for code in COLUMN_TYPECODES)
+        self._new = {}
+
+    def __len__(self):
+        return len(self.ids) + len(self._new)
+
+    def _find(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return i
+        return -1
+
+    def get(self, user_id):
+        row = self._new.get(user_id)
+        if row is not None:
+            return row
+        i = self._find(user_id)
+        if i < 0:
+            return None
+        return self.xp[i], self.level[i], self.ts[i]
+
+    def put(self, user_id, xp, level, ts):
+        """Store a user's state; returns True if the user wasn't held before."""
+        i = self._find(user_id)
+        if i >= 0:
+            self.xp[i], self.level[i], self.ts[i] = xp, level, ts
+            return False
+        is_new = user_id not in self._new
+        self._new[user_id] = (xp, level, ts)
+        if len(self._new) >= max(self.MIN_MERGE, len(self.ids) >> 5):
+            self.compact()
+        return is_new
+
+    def compact(self):
+        if not self._new:
+            return
+        # Copy the old arrays in slices between insertion points rather than element by element.
+        columns = tuple(array(code) for code in COLUMN_TYPECODES)
+        start = 0
+        for user_id in sorted(self._new):
+            i = bisect_left(self.ids, user_id, start)
+            for new, old in zip(columns, (self.ids, self.xp, self.level, self.ts)):
+                new.extend(old[start:i])
+            xp, level, ts = self._new[user_id]
+            for new, value in zip(columns, (user_id, xp, level, ts)):
+                new.append(value)
+            start = i
+        for new, old in zip(columns, (self.ids, self.xp, self.level, self.ts)):
+            new.extend(old[start:])
+        self.ids, self.xp, self.level, self.ts = columns
+        self._new.clear()
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in (self.ids, self.xp, self.level, self.ts))
+
+
+class UserStateStore:
+    """Hot (xp, level, last_message_timestamp) per (guild, user), evicting least recently used guilds.
+
+    Snapshots are only trusted when nothing was written to the database after
+    they were taken: `mark_dirty` clears the snapshot's valid flag before the
+    first write that follows it, so after a crash a stale snapshot is ignored
+    instead of rolling XP back.
+    """
+
+    def __init__(self, max_guilds=1000, max_users=2_000_000, snapshot_path=None):
+        self.max_guilds = max_guilds
+        self.max_users = max_users
+        self.snapshot_path = snapshot_path
+        self.hits = 0
+        self.misses = 0
+        self.users = 0
+        self._guilds = OrderedDict()
+        self._snapshot_valid = False
+        self._writes = 0
+
+    def __len__(self):
+        return self.users
+
+    @property
+    def guilds(self):
+        return len(self._guilds)
+
+    def nbytes(self):
+        return sum(state.nbytes() for state in self._guilds.values())
+
+    def get(self, guild_id, user_id):
+        state = self._guilds.get(guild_id)
+        row = state.get(user_id) if state is not None else None
+        if row is None:
+            self.misses += 1
+            return None
+        self._guilds.move_to_end(guild_id)
+        self.hits += 1
+        return row
+
+    def put(self, guild_id, user_id, xp, level, ts):
+        state = self._guilds.get(guild_id)
+        if state is None:
+            state = self._guilds[guild_id] = GuildUserState()
+        else:
+            self._guilds.move_to_end(guild_id)
+        if state.put(user_id, xp, level, ts):
+            self.users += 1
+            self._evict()
+
+    def invalidate(self, guild_id):
+        state = self._guilds.pop(guild_id, None)
+        if state is not None:
+            self.users -= len(state)
+
+    def _evict(self):
+        while len(self._guilds) > 1 and (len(self._guilds) > self.max_guilds or self.users > self.max_users):
+            _, state = self._guilds.popitem(last=False)
+            self.users -= len(state)
+
+    def mark_dirty(self):
+        """Call before writing user rows to the database by any path."""
+        self._writes += 1
+        if self._snapshot_valid:
+            self._snapshot_valid = False
+            invalidate_snapshot(self.snapshot_path)
+
+    async def save_snapshot(self):
+        """Snapshot to `snapshot_path`. Call right after flushing, so the database holds everything snapshotted."""
+        chunks = self._snapshot_chunks()
+        writes = self._writes
+        await asyncio.to_thread(self._write_snapshot, chunks)
+        if self._writes == writes:
+            self._snapshot_valid = True
+        else:
+            # Something was written while the file was being saved; it's stale already.
+            await asyncio.to_thread(invalidate_snapshot, self.snapshot_path)
+        return sum(map(len, chunks))
+
+    def _snapshot_chunks(self):
+        # Copies every column while nothing else can run, so the snapshot is a consistent cut.
+        chunks = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, sys.byteorder == 'little', len(self._guilds), int(time.time()))]
+        for guild_id, state in self._guilds.items():
+            state.compact()
+            chunks.append(SNAPSHOT_GUILD.pack(guild_id, len(state.ids)))
+            chunks.extend(column.tobytes() for column in (state.ids, state.xp, state.level, state.ts))
+        return chunks
+
+    def _write_snapshot(self, chunks):
+        tmp = f"{self.snapshot_path}.tmp"
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def load_snapshot(self):
+        """Rebuild state from a valid snapshot; returns the number of users loaded."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        with open(self.snapshot_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, valid, little, guild_count, written_at = SNAPSHOT_HEADER.unpack_from(mm, 0)
+                if magic != SNAPSHOT_MAGIC or not valid:
+                    logger.info(f"Ignoring user state snapshot {self.snapshot_path}: {'unknown format' if magic != SNAPSHOT_MAGIC else 'written to since it was taken'}.")
+                    return 0
+                view = memoryview(mm)
+                try:
+                    offset = SNAPSHOT_HEADER.size
+                    for _ in range(guild_count):
+                        guild_id, count = SNAPSHOT_GUILD.unpack_from(mm, offset)
+                        offset += SNAPSHOT_GUILD.size
+                        columns = []
+                        for code in COLUMN_TYPECODES:
+                            column = array(code)
+                            size = column.itemsize * count
+                            column.frombytes(view[offset:offset + size])
+                            if little != (sys.byteorder == 'little'):
+                                column.byteswap()
+                            columns.append(column)
+                            offset += size
+                        self.invalidate(guild_id)
+                        self._guilds[guild_id] = GuildUserState(tuple(columns))
+                        self.users += count
+                finally:
+                    view.release()
+        self._evict()
+        self._snapshot_valid = True
+        logger.info(f"Loaded {self.users:,} users in {len(self._guilds)} guild(s) from user state snapshot written {time.time() - written_at:.0f}s ago.")
+        return self.users
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('discord')
+
+
+class XPWriteBuffer:
+    def __init__(self, storage, flush_interval=5.0, max_pending=1000, before_flush=None):
+        self.storage = storage
+        self.before_flush = before_flush
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._dirty = {}
+        # The batch being written; still served by get() until its transaction commits,
+        # so nobody reads the older database row in the meantime.
+        self._flushing = {}
+        # (guild_id, period, bucket, user_id) -> XP gained since the last flush.
+        self._period_xp = {}
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        row = self._dirty.get(key)
+        if row is None:
+            row = self._flushing.get(key)
+        return row
+
+    def put(self, guild_id, user_id, xp, level, last_message_timestamp):
+        self._dirty[(guild_id, user_id)] = (xp, level, last_message_timestamp)
+        if len(self._dirty) >= self.max_pending:
+            self._full.set()
+
+    def add_period_xp(self, guild_id, period, bucket, user_id, xp):
+        key = (guild_id, period, bucket, user_id)
+        self._period_xp[key] = self._period_xp.get(key, 0) + xp
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty and not self._period_xp:
+                return 0
+            pending, self._dirty = self._dirty, {}
+            self._flushing = pending
+            period_pending, self._period_xp = self._period_xp, {}
+            rows = [(guild_id, user_id, xp, level, ts) for (guild_id, user_id), (xp, level, ts) in pending.items()]
+            period_rows = [(*key, xp) for key, xp in period_pending.items()]
+            try:
+                if self.before_flush is not None:
+                    self.before_flush()
+                await self.storage.upsert_users(rows, period_rows)
+            except BaseException:
+                # Put the batch back without clobbering anything written since the swap.
+                for key, value in pending.items():
+                    self._dirty.setdefault(key, value)
+                # Period XP is a delta, so what was gained since the swap adds to it.
+                for key, xp in period_pending.items():
+                    self._period_xp[key] = self._period_xp.get(key, 0) + xp
+                raise
+            finally:
+                self._flushing = {}
+            self.flushes += 1
+            self.rows_flushed += len(rows)
+            return len(rows)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Cancelling the task can be swallowed by wait_for when _full fires at the same
+        # moment, so the loop is asked to exit instead.
+        if self._task is not None:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush {len(self._dirty)} buffered XP update(s): {e}")
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Optional
+
+logger = logging.getLogger('discord')
+
+MESSAGE = 'message'
+VOICE = 'voice'
+REACTION = 'reaction'
+
+
+@dataclass
+class XPEvent:
+    """Something that may earn XP. How much is decided when the event is applied, from the guild's settings."""
+    source: str
+    guild_id: int
+    user_id: int
+    channel_id: int
+    timestamp: int
+    # Messages and reactions count 1; voice ticks count minutes spent in the channel.
+    units: float = 1
+    member: Optional[Any] = None
+    channel: Optional[Any] = None
+
+
+class XPEventQueue:
+    """Collects XP events from every source and hands them to one consumer in batches.
+
+    Whatever has queued up while the previous batch was being applied becomes
+    the next batch, so a burst costs one settings lookup and one user fetch per
+    guild instead of one per event.
+    """
+
+    def __init__(self, apply_batch, metrics, max_batch=500, max_pending=10000):
+        self.apply_batch = apply_batch
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10.0):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropped {self._queue.qsize()} unapplied XP event(s) on shutdown.")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def put(self, event, max_pending=None):
+        # `max_pending` lets a source stop short of the queue's limit, leaving room for the others.
+        limit = self.max_pending if max_pending is None else min(max_pending, self.max_pending)
+        if self._queue.qsize() >= limit:
+            self.metrics.inc('xp_events_dropped')
+            return False
+        self._queue.put_nowait(event)
+        self.metrics.inc(f'xp_events_{event.source}')
+        return True
+
+    def put_back(self, events):
+        # For events taken out of a batch and held back; they were already admitted, so the limit doesn't apply.
+        for event in events:
+            self._queue.put_nowait(event)
+
+    async def join(self):
+        await self._queue.join()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                with self.metrics.timer('stage', 'apply_batch'):
+                    await self.apply_batch(batch)
+                self.metrics.inc('xp_event_batches')
+            except Exception as e:
+                logger.error(f"Error applying {len(batch)} XP event(s): {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()